@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import os
 
-from tnparser.pipeline import Pipeline, read_pipelines
+from flask import Response
+
+from tnparser.pipeline import Pipeline, JobCancelled, read_pipelines
 
 from elg import FlaskService
 from elg.model import TextRequest
@@ -16,9 +18,26 @@ if not os.path.isfile(model):
     raise FileNotFoundError('Cannot find model setting file')
 pipeline = "parse_plaintext"
 MAX_CHAR = 15000
+# texts up to this length are parsed in this process, skipping the pipeline
+# processes and queues, 0 to always use the processes
+INPROCESS_MAX_CHAR = int(os.environ.get("TNPP_INPROCESS_MAX_CHARS", 0))
+# the service answers busy above this many characters in the pipeline, or
+# when the estimated wait for the result is longer than MAX_WAIT seconds
+MAX_CHAR_IN_FLIGHT = int(os.environ.get("TNPP_MAX_CHARS_IN_FLIGHT", 120000))
+MAX_WAIT = float(os.environ.get("TNPP_MAX_WAIT", 0))
+# a text not parsed in this many seconds is dropped from the pipeline,
+# 0 for no limit
+JOB_TIMEOUT = float(os.environ.get("TNPP_JOB_TIMEOUT", 0))
+# "thread" runs the steps as threads of this process instead of processes
+MODE = os.environ.get("TNPP_MODE", "process")
 available_pipelines = read_pipelines(model)
 
-tnpp = Pipeline(available_pipelines[pipeline])
+tnpp = Pipeline(available_pipelines[pipeline],
+                mode="hybrid" if INPROCESS_MAX_CHAR > 0 and MODE == "process"
+                else MODE,
+                inprocess_max_chars=INPROCESS_MAX_CHAR,
+                max_chars_in_flight=MAX_CHAR_IN_FLIGHT,
+                max_wait=MAX_WAIT)
 
 
 class TurkuNeuralParser(FlaskService, ConlluToJson):
@@ -56,16 +75,24 @@ class TurkuNeuralParser(FlaskService, ConlluToJson):
             return Failure(errors=[error])
         else:
             try:
-                output = tnpp.parse(content)
+                output = tnpp.parse(content, timeout=JOB_TIMEOUT)
+            except JobCancelled:
+                error = StandardMessages.\
+                    generate_elg_service_internalerror(
+                            params=['Parsing took too long'])
+                return Failure(errors=[error])
             except Exception:
                 error = StandardMessages.\
                     generate_elg_service_internalerror(
                             params=['Pipeline failed'])
                 return Failure(errors=[error])
             if output is False:
+                wait = tnpp.estimated_wait()
+                retry = f' Estimated wait {wait:.0f} seconds.' if wait else ''
                 error = StandardMessages.\
                         generate_elg_service_internalerror(params=[
-                            'The service is busy, please request it later.'
+                            'The service is busy, please request it later.' +
+                            retry
                         ])
                 return Failure(errors=[error])
             return self.conllu_to_annotation(
@@ -74,3 +101,10 @@ class TurkuNeuralParser(FlaskService, ConlluToJson):
 
 tnpp_service = TurkuNeuralParser("turku-neural-parser")
 app = tnpp_service.app
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Per step metrics of the pipeline in the Prometheus text format"""
+    return Response(tnpp.metrics_text(),
+                    mimetype="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,79 @@
+"""
+Compare the process and thread modes of Pipeline: the same CoNLL-U jobs are
+parsed in each mode, reporting the throughput and the memory (PSS, summed
+over this process and the step processes) once all of them are done.
+Without --conf-yaml the light steps are chained unfused, which measures the
+cost of the hops themselves; those steps hold the GIL, the neural steps of
+a real pipeline release it while they work.
+"""
+import os
+import time
+import argparse
+
+from tnparser.pipeline import Pipeline, read_pipelines
+
+
+def pss_kb(pid):
+    """Proportional set size of a process in kB, None where /proc does not tell"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def memory_mb(p):
+    sizes = [pss_kb(os.getpid())] + [
+        pss_kb(proc.pid) for proc in p.processes
+        if getattr(proc, "pid", None) is not None and p.mode == "process"
+    ]
+    if None in sizes:
+        return None
+    return sum(sizes) / 1024
+
+
+def make_job(sentences):
+    return "".join(
+        f"# sent_id = {s}\n" + "".join(
+            f"{i}\tsana{i}\tsana\tNOUN\t_\tCase=Nom\t{i-1}\t{'root' if i == 1 else 'dep'}\t_\t_\n"
+            for i in range(1, 11)) + "\n" for s in range(sentences))
+
+
+def run(mode, steps, jobs, sentences):
+    p = Pipeline(steps, mode=mode, fuse=False)
+    txt = make_job(sentences)
+    p.parse(txt)  #models loaded and steps running before the clock starts
+    start = time.time()
+    ids = [p.put(txt) for _ in range(jobs)]
+    for job_id in ids:
+        p.get(job_id)
+    elapsed = time.time() - start
+    memory = memory_mb(p)
+    p.send_final()
+    p.join()
+    return elapsed, memory
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("--conf-yaml", help="YAML with pipeline configs, to measure a real pipeline")
+    argparser.add_argument("--pipeline", default="parse_conllu", help="Pipeline to run from --conf-yaml. Default %(default)s")
+    argparser.add_argument("--steps", nargs="+", default=["dummy_mod", "wipe_mod", "clean_lemmas_mod", "dummy_mod"], help="Steps to run without --conf-yaml. Default %(default)s")
+    argparser.add_argument("--jobs", type=int, default=200, help="Number of jobs to parse. Default %(default)d")
+    argparser.add_argument("--sentences", type=int, nargs="+", default=[10, 100, 1000], help="Sentences of ten tokens per job. Default %(default)s")
+    args = argparser.parse_args()
+
+    if args.conf_yaml:
+        steps = [step for step in read_pipelines(args.conf_yaml)[args.pipeline]
+                 if not (isinstance(step, str) and step.startswith("extraoptions"))]
+    else:
+        steps = args.steps
+    print("sentences\tmode\tjobs/s\ttokens/s\tPSS MB")
+    for sentences in args.sentences:
+        for mode in ("process", "thread"):
+            elapsed, memory = run(mode, steps, args.jobs, sentences)
+            memory = f"{memory:.0f}" if memory is not None else "-"
+            print(f"{sentences}\t{mode}\t{args.jobs/elapsed:.1f}\t{args.jobs*sentences*10/elapsed:.0f}\t{memory}", flush=True)
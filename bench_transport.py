@@ -0,0 +1,85 @@
+"""
+Measure the cost of one pipeline hop with the plain queue transport and the
+shared memory transport: jobs are sent through a chain of relay processes
+which only get() and put() them, like a pipeline step that does no work.
+With --document the jobs are CoNLL-U Documents, as the steps pass them on.
+"""
+import time
+import argparse
+import multiprocessing
+
+from tnparser.conllu import Document
+
+
+def relay(q_in, q_out):
+    while True:
+        jobid, txt = q_in.get()
+        q_out.put((jobid, txt))
+        if jobid == "FINAL":
+            return
+
+
+def make_queue(ctx, transport, maxsize):
+    q = ctx.Queue(maxsize)
+    if transport == "shm":
+        from tnparser.transport import SharedMemoryQueue
+        q = SharedMemoryQueue(q, min_bytes=1)  #measure the segments for every size
+    return q
+
+
+def make_job(chars, document):
+    if not document:
+        return ("Tämä on testilause.\t" * (chars // 20 + 1))[:chars]
+    row = "1\tTämä\ttämä\tPRON\tPron\tCase=Nom|Number=Sing\t0\troot\t_\tSpaceAfter=No\n"
+    return Document.from_conllu((row + "\n") * max(1, chars // (len(row) + 1)))
+
+
+def size(job):
+    return len(job) if isinstance(job, str) else job.num_rows()
+
+
+def run(transport, hops, jobs, chars, document=False, maxsize=5):
+    ctx = multiprocessing.get_context()
+    if transport == "shm":
+        from tnparser import transport as shm_transport
+        shm_transport.prepare()
+    queues = [make_queue(ctx, transport, maxsize) for _ in range(hops + 1)]
+    processes = []
+    for q_in, q_out in zip(queues, queues[1:]):
+        p = ctx.Process(target=relay, args=(q_in, q_out), daemon=True)
+        p.start()
+        processes.append(p)
+    txt = make_job(chars, document)
+    start = time.time()
+    sent = 0
+    received = 0
+    while received < jobs:  #keep the chain full but never block on put
+        while sent < jobs and sent - received < maxsize:
+            queues[0].put((str(sent), txt))
+            sent += 1
+        jobid, res = queues[-1].get()
+        assert size(res) == size(txt)
+        received += 1
+    elapsed = time.time() - start
+    queues[0].put(("FINAL", ""))
+    queues[-1].get()
+    for p in processes:
+        p.join()
+    return elapsed
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("--hops", type=int, default=6, help="Number of relay processes. Default %(default)d")
+    argparser.add_argument("--jobs", type=int, default=500, help="Number of jobs to send. Default %(default)d")
+    argparser.add_argument("--chars", type=int, nargs="+", default=[1000, 15000, 150000, 1500000], help="Job sizes in characters. Default %(default)s")
+    argparser.add_argument("--document", default=False, action="store_true", help="Send Documents of about that many characters of CoNLL-U instead of text")
+    args = argparser.parse_args()
+
+    print("chars\ttransport\tms/job/hop\tMB/s/hop")
+    for chars in args.chars:
+        for transport in ("queue", "shm"):
+            elapsed = run(transport, args.hops, args.jobs, chars, args.document)
+            per_hop = elapsed / args.jobs / args.hops
+            mb = chars / 1e6
+            print(f"{chars}\t{transport}\t{per_hop*1000:.3f}\t{mb/per_hop:.1f}", flush=True)
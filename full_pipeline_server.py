@@ -2,7 +2,7 @@ import yaml
 import os
 import flask
 import sys
-from tnparser.pipeline import Pipeline, read_pipelines
+from tnparser.pipeline import Pipeline, JobCancelled, read_pipelines
 #from full_pipeline_stream import read_pipelines
 
 app=flask.Flask(__name__)
@@ -14,6 +14,10 @@ def parse_get():
     if not txt:
         return "You need to specify ?text=sometext",400
     res=parse(txt,p)
+    if res is False:
+        return busy(p)
+    if res is None:
+        return timed_out()
     return flask.Response(res,mimetype="text/plain; charset=utf-8")
 
 @app.route("/",methods=["POST"])
@@ -26,21 +30,33 @@ def parse_post():
         return """You need to post your data as a single string. An example request would be curl --request POST --data 'Tämä on testilause' http://localhost:7689\n\n\n""",400
     else:
         res=parse(txt,p)
+    if res is False:
+        return busy(p)
+    if res is None:
+        return timed_out()
     return flask.Response(res,mimetype="text/plain; charset=utf-8")
-    
+
+@app.route("/metrics",methods=["GET"])
+def metrics():
+    global p
+    return flask.Response(p.metrics_text(),mimetype="text/plain; version=0.0.4; charset=utf-8")
     
 
 
 
 def parse(txt,p):
-    job_id=p.put(txt)
-    while True:
-        res=p.get(job_id)
-        if res is None:
-            time.sleep(0.1)
-        else:
-            break
-    return res
+    try:
+        return p.parse(txt,timeout=args.job_timeout) #False if the pipeline has no room for the text
+    except JobCancelled: #None if it was not parsed in time
+        return None
+
+def busy(p):
+    wait=p.estimated_wait()
+    retry_after=str(max(1,int(wait))) if wait is not None else "1"
+    return flask.Response("The parser is busy, please try again later.\n",status=503,headers={"Retry-After":retry_after},mimetype="text/plain; charset=utf-8")
+
+def timed_out():
+    return flask.Response("Parsing took too long and was given up.\n",status=504,mimetype="text/plain; charset=utf-8")
 
 if __name__=="__main__":
     import argparse
@@ -55,6 +71,10 @@ if __name__=="__main__":
     general_group.add_argument('--port',default=7689,type=int,help="Port at which to run. Default %(default)d")
     general_group.add_argument('--host',default="localhost",help="Host on which to bind. Default %(default)s")
     general_group.add_argument('--max-char', default=0, type=int, help='Number of chars maximum in a job batch. Cuts longer. Zero for no limit. Default %(default)d')
+    general_group.add_argument('--max-chars-in-flight', default=120000, type=int, help='Answer busy (503) to new texts when this many chars are being parsed. Default %(default)d')
+    general_group.add_argument('--max-wait', default=0, type=float, help='Answer busy (503) when the estimated wait for the result is longer than this many seconds. Zero for no limit. Default %(default)s')
+    general_group.add_argument('--job-timeout', default=0, type=float, help='Give up on a text which is not parsed in this many seconds and answer 504, its job is dropped from the pipeline. Zero for no limit. Default %(default)s')
+    general_group.add_argument('--inprocess-max-char', default=0, type=int, help='Texts up to this many chars are parsed inside the server process, without the round trips through the pipeline processes. Costs a second copy of the models. Zero to never do this. Default %(default)d')
     
     lemmatizer_group = argparser.add_argument_group(title='lemmatizer_mod', description='Lemmatizer arguments')
     lemmatizer_group.add_argument('--gpu', dest='lemmatizer_mod.gpu', type=int, default=0, help='GPU device id for the lemmatizer, if -1 use CPU')
@@ -70,14 +90,14 @@ if __name__=="__main__":
     else:
         pipeline=pipelines[args.action]
 
-    if pipeline[0].startswith("extraoptions"):
+    if isinstance(pipeline[0],str) and pipeline[0].startswith("extraoptions"):
         extraoptions=pipeline[0].split()[1:]
         pipeline.pop(0)
         newoptions=extraoptions+sys.argv[1:]
         print("Got extra arguments from the pipeline, now running with", newoptions, file=sys.stderr, flush=True)
         args=argparser.parse_args(newoptions)
 
-    p=Pipeline(steps=pipeline, extra_args=args)
+    p=Pipeline(steps=pipeline, extra_args=args, mode="hybrid" if args.inprocess_max_char>0 else "process", inprocess_max_chars=args.inprocess_max_char, max_chars_in_flight=args.max_chars_in_flight, max_wait=args.max_wait)
 
     app.run(host=args.host,port=args.port,threaded=True,processes=1,use_reloader=False)
             
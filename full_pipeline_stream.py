@@ -1,34 +1,13 @@
-from tnparser.pipeline import Pipeline, read_pipelines
+from tnparser.pipeline import Pipeline, Batcher, model_batch_tokens, read_pipelines
 import sys
 import select
 import os
 import yaml
 import time
-import gzip
 import re
+from tnparser.streams import open_input, read_ahead
 
 
-def batch_endswith_text(lines):
-    global comment_regex
-    for line in lines[::-1]:
-        if not line.strip(): #skip empty lines
-            continue
-        if comment_regex.match(line):
-            return False
-        return True
-    return False
-
-def batch_has_text(lines):
-    global comment_regex
-    for line in lines:
-        if not line.strip():
-            continue
-        if comment_regex.match(line):
-            continue
-        return True
-    return False
-    
-
 if __name__=="__main__":
     import argparse
     THISDIR=os.path.dirname(os.path.abspath(__file__))
@@ -37,8 +16,13 @@ if __name__=="__main__":
     general_group = argparser.add_argument_group(title='General', description='General pipeline arguments')
     general_group.add_argument('--conf-yaml', default=os.path.join(THISDIR,"pipelines.yaml"), help='YAML with pipeline configs. Default: parser_dir/pipelines.yaml')
     general_group.add_argument('--pipeline', default="parse_plaintext", help='[DEPRECATED] Name of the pipeline to run, one of those given in the YAML file. Default: %(default)s')
+    general_group.add_argument('--input', default="-", help='File to parse, read as gzip, bz2 or xz if it is compressed. Default: stdin')
+    general_group.add_argument('--output', default="-", help='File to write, compressed if the name ends with .gz, .bz2 or .xz. Default: stdout')
     general_group.add_argument('--empty-line-batching', default=False, action="store_true", help='Only ever batch on newlines (useful with pipelines that input conllu)')
-    general_group.add_argument('--batch-lines', default=1000, type=int, help='Number of lines in a job batch. Default %(default)d, consider setting a higher value if using conllu input instead of raw text (maybe 5000 lines), and try smaller values in case of running out of memory with raw text.')
+    general_group.add_argument('--batch-chars', default=100000, type=int, help='Number of characters in a job batch, which keeps the batches of about the same size whatever the length of the lines. Zero for no limit. Default %(default)d, try smaller values in case of running out of memory.')
+    general_group.add_argument('--batch-tokens', default=0, type=int, help='Number of tokens (words of text, rows of conllu) in a job batch. Zero for no limit. Default %(default)d')
+    general_group.add_argument('--batch-lines', default=0, type=int, help='Number of lines in a job batch. Zero for no limit. Default %(default)d. A batch is cut at the first of these limits it reaches.')
+    general_group.add_argument('--model-batches', default=0, type=int, help='Size the job batches to this many prediction batches of the parser (its --batch_size tokens), instead of the limits above. Default %(default)d: off')
     general_group.add_argument('--device', type=int, default=-1, help='GPU device id, if -1 use CPU')
     general_group.add_argument('action', default=None, nargs='?', help="What to do. Either 'list' to lists pipelines or a pipeline name to parse, or nothing in which case the default parse_plaintext is used.")
 
@@ -61,7 +45,7 @@ if __name__=="__main__":
     elif args.action is None or args.action=="parse":
         pipeline=pipelines[args.pipeline]
         
-    if pipeline[0].startswith("extraoptions"):
+    if isinstance(pipeline[0],str) and pipeline[0].startswith("extraoptions"):
         extraoptions=pipeline[0].split()[1:]
         pipeline.pop(0)
         newoptions=extraoptions+sys.argv[1:]
@@ -72,31 +56,35 @@ if __name__=="__main__":
         args.__dict__["lemmatizer_mod.device"]=args.device
 
 
+    inp=open_input(args.input) #before the steps start, a wrong path ends here
     pipeline.append("output_mod")
+    args.__dict__["output_mod.output"]=args.output
     p=Pipeline(steps=pipeline, extra_args=args)
 
+    if args.model_batches>0:
+        tokens=model_batch_tokens(pipeline,args)
+        if tokens:
+            args.batch_lines,args.batch_chars,args.batch_tokens=0,0,tokens*args.model_batches
+        else:
+            print("No step of the pipeline tells its batch size, --model-batches ignored",file=sys.stderr,flush=True)
+    batcher=Batcher(args.batch_lines,args.batch_chars,args.batch_tokens,args.empty_line_batching)
+
     print("Waiting for input",file=sys.stderr,flush=True)
-    comment_regex=re.compile("^####?C:")
-    line_buffer=[]
-    for line in sys.stdin:
-        line_buffer.append(line)
-        if not comment_regex.match(line) and (line.strip()=="" or not args.empty_line_batching) and len(line_buffer)>args.batch_lines and batch_endswith_text(line_buffer):
+    for line in read_ahead(inp): #decompressed by a thread while the batches are parsed
+        batch=batcher.add(line)
+        if batch is not None:
             if not p.is_alive(): #gotta end if something dies
                 print("Something crashed. Exiting.",file=sys.stderr,flush=True)
                 sys.exit(-1)
             print("Feeding a batch",file=sys.stderr,flush=True)
-            p.put("".join(line_buffer))
-            line_buffer=[]
-    else:
-        if line_buffer:
-            if not batch_has_text(line_buffer):
-                print("WARNING: Comments and empty lines at the end of the input will be removed in order to produce valid conll-u. The input must not end with comments",file=sys.stderr,flush=True)
-            else:
-                if not p.is_alive(): #gotta end if something dies
-                    print("Something crashed. Exiting.",file=sys.stderr,flush=True)
-                    sys.exit(-1)
-                print("Feeding final batch",file=sys.stderr,flush=True)
-                p.put("".join(line_buffer))
+            p.put(batch,fetch=False) #output_mod writes the result
+    batch=batcher.finish()
+    if batch is not None:
+        if not p.is_alive(): #gotta end if something dies
+            print("Something crashed. Exiting.",file=sys.stderr,flush=True)
+            sys.exit(-1)
+        print("Feeding final batch",file=sys.stderr,flush=True)
+        p.put(batch,fetch=False) #output_mod writes the result
 
     p.send_final()
     p.join()
@@ -1,7 +1,9 @@
 import json
+import pickle
 import unittest
 import os
 from utils.utils import ConlluToJson
+from tnparser.conllu import Document, LEMMA, MISC
 import requests
 
 # pre-setup for loading data to test
@@ -112,6 +114,49 @@ class TestConlluToJsonInSingleDocumentParse(unittest.TestCase):
         self.assertEqual(int(last_tok['end']), len(text))
 
 
+class TestDocument(unittest.TestCase):
+
+    with open(os.path.join(os.path.dirname(__file__), 'double.doc.conllu'),
+              'r') as f:
+        conllu = f.read()
+
+    def test_round_trip(self):
+        """Parsing and printing should not change the sentences"""
+        doc = Document.from_conllu(self.conllu)
+        self.assertEqual(doc.to_conllu().strip(), self.conllu.strip())
+
+    def test_pickle_round_trip(self):
+        """A document sent to the next step should arrive unchanged"""
+        doc = Document.from_conllu(self.conllu)
+        doc.cols[LEMMA] = ["_"] * doc.num_rows()
+        copy = pickle.loads(pickle.dumps(doc))
+        self.assertEqual(copy.to_conllu(), doc.to_conllu())
+
+    def test_sentences(self):
+        """Rebuilding from sentences should keep the document"""
+        doc = Document.from_conllu(self.conllu)
+        self.assertEqual(
+            Document.from_sentences(doc.sentences()).to_conllu(),
+            doc.to_conllu())
+
+    def test_empty_last_column(self):
+        """A row with an empty MISC should not cut MISC from the other rows"""
+        conllu = ("1\tKoira\tkoira\tNOUN\t_\t_\t2\tnsubj\t_\tSpaceAfter=No\n"
+                  "2\thaukkuu\thaukkua\tVERB\t_\t_\t0\troot\t_\t\n\n")
+        doc = Document.from_conllu(conllu)
+        self.assertEqual(doc.cols[MISC], ["SpaceAfter=No", ""])
+        self.assertEqual(doc.to_conllu(), conllu)
+
+    def test_short_row(self):
+        """A row with missing columns should be filled up, not crash the step"""
+        conllu = ("1\tKoira\tkoira\tNOUN\t_\t_\t2\tnsubj\t_\tSpaceAfter=No\n"
+                  "2\thaukkuu\thaukkua\tVERB\t_\t_\t0\troot\n\n")
+        doc = Document.from_conllu(conllu)
+        self.assertEqual(doc.num_rows(), 2)
+        self.assertEqual(doc.cols[MISC], ["SpaceAfter=No", "_"])
+        self.assertEqual(doc.rows()[1][:8], conllu.split("\n")[1].split("\t"))
+
+
 class TestResponse(unittest.TestCase):
     base_url = 'http://localhost:8000/process'
 
@@ -0,0 +1,26 @@
+import unittest
+
+try:
+    from tnparser.diaparser_mod import length_batches
+except ImportError:  #diaparser is not installed
+    length_batches = None
+
+
+@unittest.skipIf(length_batches is None, "diaparser is not installed")
+class TestLengthBatches(unittest.TestCase):
+
+    dset = [["w"] * n for n in (3, 10, 1, 4, 2, 4)]
+
+    def test_batches(self):
+        """Longest first, each batch within max_tokens counting the padding"""
+        batches = list(length_batches(self.dset, 8))
+        self.assertEqual(batches, [[1], [3, 5], [0, 4], [2]])
+        self.assertEqual(sorted(sum(batches, [])), list(range(len(self.dset))))
+
+    def test_no_sentences(self):
+        """No sentences are no batches"""
+        self.assertEqual(list(length_batches([], 8)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
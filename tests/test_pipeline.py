@@ -0,0 +1,781 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+import unittest
+from tnparser import dummy_mod
+from tnparser.conllu import to_conllu
+from tnparser.metrics import Metrics
+from tnparser.output_mod import in_order
+from tnparser.pipeline import (BULK, INTERACTIVE, Batcher, Pipeline,
+                               JobCancelled, JobFailed, feed_replicas,
+                               launch_coalesced, merge_replicas, parse_cpus,
+                               plan_routes, step_config, stitch_chunks,
+                               text_chunks)
+
+
+def sentence(form):
+    return f"1\t{form}\t{form.lower()}\tNOUN\t_\t_\t0\troot\t_\tSpaceAfter=No\n\n"
+
+
+def parsed(form):
+    """sentence(form) after wipe_mod and dummy_mod"""
+    return f"1\t{form}\t_\t_\t_\t_\t0\t_\t_\tSpaceAfter=No\n\n"
+
+
+forms = [f"Sana{i}" for i in range(20)]
+
+
+class TestReplicas(unittest.TestCase):
+
+    def test_merge_in_order(self):
+        """Jobs finished out of order by the replicas should leave in the order they came"""
+        q_in, q_replicas_in = queue.Queue(), queue.Queue()
+        q_replicas_out, q_out = queue.Queue(), queue.Queue()
+        for i in range(5):
+            q_in.put((f"{i}-job", str(i)))
+        q_in.put(("FINAL", ""))
+        feed_replicas(q_in, q_replicas_in, 2)
+        items = [q_replicas_in.get() for _ in range(7)]
+        self.assertEqual(items[-2:], [("FINAL", ""), ("FINAL", "")])
+        for item in reversed(items[:-2]):
+            q_replicas_out.put(item)
+        for item in items[-2:]:
+            q_replicas_out.put(item)
+        merge_replicas(q_replicas_out, q_out, 2)
+        results = [q_out.get() for _ in range(6)]
+        self.assertEqual(results, [(f"{i}-job", str(i))
+                                   for i in range(5)] + [("FINAL", "")])
+
+    def test_merge_skips_tombstones(self):
+        """A job lost in a dead replica should not be waited for nor passed on"""
+        q_replicas, q_out = queue.Queue(), queue.Queue()
+        for item in [("1#1-b", "b"), ("0#0-a", None), ("0#0-a", "a"),
+                     ("FINAL", "")]:
+            q_replicas.put(item)
+        merge_replicas(q_replicas, q_out, 1)
+        self.assertEqual([q_out.get() for _ in range(2)],
+                         [("1-b", "b"), ("FINAL", "")])
+
+
+class TestPipeline(unittest.TestCase):
+
+    def run_pipeline(self, steps, **kwargs):
+        p = Pipeline(steps, **kwargs)
+        try:
+            job_ids = [p.put(sentence(form)) for form in forms]
+            return [p.get(job_id) for job_id in job_ids]
+        finally:
+            p.send_final()
+
+    def test_process(self):
+        """Every step in a process of its own"""
+        self.assertEqual(self.run_pipeline(["wipe_mod", "dummy_mod"],
+                                           fuse=False),
+                         [parsed(form) for form in forms])
+
+    def test_fused(self):
+        """Light steps fused into one process"""
+        self.assertEqual(self.run_pipeline(["wipe_mod", "dummy_mod"]),
+                         [parsed(form) for form in forms])
+
+    def test_thread(self):
+        """Every step in a thread of this process"""
+        self.assertEqual(self.run_pipeline(["wipe_mod", "dummy_mod"],
+                                           mode="thread"),
+                         [parsed(form) for form in forms])
+
+    def test_replicas(self):
+        """A replicated step should keep the results in order"""
+        self.assertEqual(
+            self.run_pipeline(
+                ["wipe_mod", dict(step="dummy_mod", replicas="3")],
+                fuse=False), [parsed(form) for form in forms])
+
+    def test_inprocess(self):
+        """The steps run one after another in this process"""
+        self.assertEqual(self.run_pipeline(["wipe_mod", "dummy_mod"],
+                                           mode="inprocess"),
+                         [parsed(form) for form in forms])
+
+    def test_hybrid(self):
+        """A short text is parsed in this process, a longer one by the step processes"""
+        p = Pipeline(["wipe_mod", "dummy_mod"],
+                     mode="hybrid",
+                     inprocess_max_chars=len(sentence(forms[0])))
+        try:
+            self.assertTrue(p.route_inprocess(sentence(forms[0])))
+            self.assertFalse(p.route_inprocess(sentence(forms[10])))
+            for form in forms:
+                self.assertEqual(p.parse(sentence(form)), parsed(form))
+        finally:
+            p.send_final()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        """The counters and histograms of a step in the Prometheus text format"""
+        metrics = Metrics()
+        metrics.add_step('dummy_mod --name "x"')
+        metrics.record('dummy_mod --name "x"', 0.2, 0.003, 40, 50, 1, 2)
+        text = metrics.render()
+        stage = 'stage="dummy_mod --name \\"x\\""'
+        for line in [
+                f"tnpp_stage_jobs_total{{{stage}}} 1",
+                f"tnpp_stage_tokens_total{{{stage}}} 2",
+                f"tnpp_stage_input_chars_total{{{stage}}} 40",
+                f'tnpp_stage_processing_seconds_bucket{{{stage},le="0.1"}} 0',
+                f'tnpp_stage_processing_seconds_bucket{{{stage},le="0.5"}} 1',
+                f'tnpp_stage_processing_seconds_bucket{{{stage},le="+Inf"}} 1',
+                f"tnpp_stage_processing_seconds_count{{{stage}}} 1",
+                f'tnpp_stage_queue_wait_seconds_bucket{{{stage},le="0.005"}} 1'
+        ]:
+            self.assertIn(line + "\n", text)
+
+    def test_metrics_text(self):
+        """A parsed job is counted for its steps, the fused ones as one"""
+        p = Pipeline(["wipe_mod", "dummy_mod"], metrics=True)
+        try:
+            p.parse(sentence(forms[0]))
+            stage = 'stage="wipe_mod + dummy_mod"'
+            deadline = time.time() + 10
+            while (f"tnpp_stage_jobs_total{{{stage}}} 1" not in p.metrics_text()
+                   and time.time() < deadline):  #reported by the step process
+                time.sleep(0.01)
+            text = p.metrics_text()
+            for line in [
+                    "tnpp_chars_in_flight 0",
+                    f"tnpp_stage_jobs_total{{{stage}}} 1",
+                    f"tnpp_stage_skipped_total{{{stage}}} 0",
+                    f"tnpp_stage_sentences_total{{{stage}}} 1",
+                    f"tnpp_stage_tokens_total{{{stage}}} 1",
+                    f'tnpp_stage_processing_seconds_bucket{{{stage},le="+Inf"}} 1',
+                    f"tnpp_stage_queue_wait_seconds_count{{{stage}}} 1"
+            ]:
+                self.assertIn(line + "\n", text)
+        finally:
+            p.send_final()
+
+
+class TestCoalesced(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_text = dummy_mod.parse_text
+        self.calls = []
+
+        def parse_text(doc):  #the stage of dummy_mod
+            self.calls.append(len(doc))
+            return self.parse_text(doc)
+
+        dummy_mod.parse_text = parse_text
+
+    def tearDown(self):
+        dummy_mod.parse_text = self.parse_text
+
+    def run_coalesced(self, max_tokens):
+        """The results of forms[:4] and the number of sentences of each stage call"""
+        q_in, q_out = queue.Queue(), queue.Queue()
+        for i, form in enumerate(forms[:4]):
+            q_in.put((f"{i}-job", sentence(form).replace("\t0\t", "\t_\t")))
+        q_in.put(("FINAL", ""))
+        args = dummy_mod.argparser.parse_args([])
+        launch_coalesced(("dummy_mod", args, 1.0, max_tokens), q_in, q_out)
+        results = [q_out.get() for _ in range(5)]
+        self.assertEqual(results[-1], ("FINAL", ""))
+        self.assertEqual(
+            [(jobid, to_conllu(doc)) for jobid, doc in results[:-1]],
+            [(f"{i}-job", sentence(form)) for i, form in enumerate(forms[:4])])
+        return self.calls
+
+    def test_window(self):
+        """The jobs waiting within the window are one stage call, split back per job"""
+        self.assertEqual(self.run_coalesced(0), [4])
+
+    def test_max_tokens(self):
+        """A call takes jobs up to the token budget"""
+        self.assertEqual(self.run_coalesced(2), [2, 2])
+
+
+class TestInOrder(unittest.TestCase):
+
+    def test_in_order(self):
+        """output_mod should print the jobs in order, each once, and skip the dropped ones"""
+        q = queue.Queue()
+        for item in [("1-b", "b"), ("0-a", "a"), ("0-a", "a again"),
+                     ("2-c", None), ("3-d", "d"), ("FINAL", "")]:
+            q.put(item)
+        self.assertEqual(list(in_order(q)), [("0-a", "a"), ("1-b", "b"),
+                                             ("3-d", "d"), ("FINAL", "")])
+
+
+class TestSupervisor(unittest.TestCase):
+    """A step which dies on one job should fail that job only"""
+
+    def setUp(self):
+        self.parse_text = dummy_mod.parse_text
+
+        def parse_text(txt):  #inherited by the forked steps
+            doc = self.parse_text(txt)
+            if "Crash" in doc.cols[1]:
+                raise RuntimeError("crashing on purpose")
+            return doc
+
+        dummy_mod.parse_text = parse_text
+
+    def tearDown(self):
+        dummy_mod.parse_text = self.parse_text
+
+    def run_pipeline(self, steps, **kwargs):
+        words = list(forms[:8])
+        words[3] = "Crash"
+        p = Pipeline(steps, fuse=False, **kwargs)
+        try:
+            job_ids = [p.put(sentence(form)) for form in words]
+            results = []
+            for job_id in job_ids:
+                try:
+                    results.append(p.get(job_id, timeout=30))
+                except JobFailed:
+                    results.append(None)
+            self.assertEqual(p.chars_in_flight, 0)
+            return results
+        finally:
+            p.send_final()
+
+    def expected(self):
+        results = [parsed(form) for form in forms[:8]]
+        results[3] = None
+        return results
+
+    def test_process(self):
+        """The step process is restarted and the other jobs replayed"""
+        self.assertEqual(self.run_pipeline(["wipe_mod", "dummy_mod"]),
+                         self.expected())
+
+    def test_thread(self):
+        """The step thread is restarted"""
+        self.assertEqual(
+            self.run_pipeline(["wipe_mod", "dummy_mod"], mode="thread"),
+            self.expected())
+
+    def test_coalesced(self):
+        """The crash is counted against the bad job, not the ones coalesced with it"""
+        self.assertEqual(
+            self.run_pipeline(
+                ["wipe_mod",
+                 dict(step="dummy_mod", coalesce_window="0.2")]),
+            self.expected())
+
+    def test_replicas(self):
+        """The replica is restarted and the merge does not wait for its jobs"""
+        self.assertEqual(
+            self.run_pipeline(
+                ["wipe_mod", dict(step="dummy_mod", replicas="2")]),
+            self.expected())
+
+    def test_preloaded(self):
+        """The preloaded replica is forked again"""
+        self.assertEqual(
+            self.run_pipeline([
+                "wipe_mod",
+                dict(step="dummy_mod", replicas="2", preload="true")
+            ]), self.expected())
+
+
+class TestCancel(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_text = dummy_mod.parse_text
+
+        def parse_text(txt):  #slow enough to cancel the jobs behind
+            time.sleep(0.2)
+            return self.parse_text(txt)
+
+        dummy_mod.parse_text = parse_text
+        self.p = Pipeline(["wipe_mod", "dummy_mod"], fuse=False)
+
+    def tearDown(self):
+        self.p.send_final()
+        dummy_mod.parse_text = self.parse_text
+
+    def assert_released(self):
+        """Nothing of the cancelled jobs should be left once the others are done"""
+        self.assertEqual(self.p.chars_in_flight, 0)
+        self.assertEqual(self.p.job_chars, {})
+        self.assertEqual(self.p.jobs, {})
+
+    def test_cancel(self):
+        """A cancelled job fails, the others are done"""
+        job_ids = [self.p.put(sentence(form)) for form in forms[:4]]
+        self.assertTrue(self.p.cancel(job_ids[2]))
+        self.assertFalse(self.p.cancel(job_ids[2]))
+        for job_id, form in zip(job_ids[:2] + job_ids[3:],
+                                forms[:2] + forms[3:4]):
+            self.assertEqual(self.p.get(job_id), parsed(form))
+        with self.assertRaises(KeyError):  #forgotten right away
+            self.p.get(job_ids[2])
+        self.assert_released()
+
+    def test_timeout(self):
+        """A job not done in time fails with JobCancelled"""
+        job_id = self.p.put(sentence(forms[0]))
+        with self.assertRaises(JobCancelled):
+            self.p.parse(sentence(forms[1]), timeout=0.1)
+        self.assertEqual(self.p.get(job_id), parsed(forms[0]))
+        self.assert_released()
+
+    def test_async_cancelled(self):
+        """A job whose awaiting task is cancelled is cancelled too"""
+
+        async def parse():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.p.parse_async(sentence(forms[0])),
+                                       0.1)
+            return await self.p.parse_async(sentence(forms[1]))
+
+        self.assertEqual(asyncio.run(parse()), parsed(forms[1]))
+        self.assert_released()
+
+
+class TestLanes(unittest.TestCase):
+    """The order in which the jobs waiting at the entry go into the steps"""
+
+    def setUp(self):
+        self.parse_text = dummy_mod.parse_text
+        self.started = multiprocessing.Event()
+        self.go_on = multiprocessing.Event()
+        self.order = multiprocessing.Queue()
+
+        def parse_text(txt):  #inherited by the forked step
+            self.started.set()
+            self.go_on.wait()
+            doc = self.parse_text(txt)
+            self.order.put(doc.cols[1][0])
+            return doc
+
+        dummy_mod.parse_text = parse_text
+
+    def tearDown(self):
+        self.go_on.set()
+        dummy_mod.parse_text = self.parse_text
+
+    def run_pipeline(self, waiting, **kwargs):
+        """
+        Parse waiting, [(form, priority)], put while the step is busy and its
+        input queue full, return the forms in the order they were parsed
+        """
+        p = Pipeline([dict(step="dummy_mod", queue_size="1")], **kwargs)
+        try:
+            job_ids = [p.put(sentence("Eka"))]
+            self.started.wait(10)
+            for form in ["Toka", "Kolmas"]:  #into the queue, then held by the entry thread
+                job_ids.append(p.put(sentence(form)))
+                while p.entry[0]:
+                    time.sleep(0.01)
+            for form, priority in waiting:
+                job_ids.append(p.put(sentence(form), priority=priority))
+            self.go_on.set()
+            for job_id in job_ids:
+                p.get(job_id, timeout=30)
+            return [self.order.get() for _ in job_ids][3:]
+        finally:
+            p.send_final()
+
+    def test_priority(self):
+        """A job of a lower priority number overtakes the ones waiting before it"""
+        self.assertEqual(
+            self.run_pipeline([("Bulk", BULK), ("Iso", BULK),
+                               ("Kiire", INTERACTIVE)]),
+            ["Kiire", "Bulk", "Iso"])
+
+    def test_shortest_first(self):
+        """Among the jobs of the same priority the shortest goes first"""
+        self.assertEqual(
+            self.run_pipeline([("Pitkä" * 5, BULK), ("Lyhyt", BULK),
+                               ("Keskipitkä", BULK)],
+                              shortest_first=True),
+            ["Lyhyt", "Keskipitkä", "Pitkä" * 5])
+
+    def test_oldest_first(self):
+        """Without shortest_first the jobs of the same priority go in order"""
+        self.assertEqual(
+            self.run_pipeline([("Pitkä" * 5, BULK), ("Lyhyt", BULK)]),
+            ["Pitkä" * 5, "Lyhyt"])
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_text = dummy_mod.parse_text
+
+        def parse_text(txt):  #slow enough to find the job in flight
+            time.sleep(0.2)
+            return self.parse_text(txt)
+
+        dummy_mod.parse_text = parse_text
+
+    def tearDown(self):
+        dummy_mod.parse_text = self.parse_text
+
+    def test_idle(self):
+        """An idle pipeline admits a text of any length"""
+        p = Pipeline(["dummy_mod"], max_chars_in_flight=10, max_wait=0.001)
+        try:
+            self.assertIsNone(p.estimated_wait(1000))
+            self.assertTrue(p.admit(1000))
+        finally:
+            p.send_final()
+
+    def test_max_chars_in_flight(self):
+        """A text which would take the characters in flight over the limit is refused"""
+        job = sentence(forms[0])
+        p = Pipeline(["dummy_mod"], max_chars_in_flight=2 * len(job))
+        try:
+            job_id = p.put(job)
+            self.assertTrue(p.admit(len(job)))
+            self.assertFalse(p.admit(len(job) + 1))
+            p.get(job_id)
+            self.assertTrue(p.admit(10 * len(job)))
+        finally:
+            p.send_final()
+
+    def test_max_wait(self):
+        """Once the throughput is measured a text which would wait too long is refused"""
+        job = sentence(forms[0])
+        p = Pipeline(["dummy_mod"], max_wait=30.0)
+        try:
+            job_id = p.put(job)
+            self.assertTrue(p.admit(100 * len(job)))  #nothing measured yet
+            p.get(job_id)
+            self.assertLess(p.estimated_wait(), 0.1)  #nothing in flight
+            job_id = p.put(job)
+            self.assertTrue(p.admit(len(job)))
+            self.assertFalse(p.admit(1000 * len(job)))  #some 200 seconds
+            p.get(job_id)
+        finally:
+            p.send_final()
+
+
+class TestChunks(unittest.TestCase):
+
+    txt = ("Eka kappale. Toinen lause.\n\nToka kappale on tässä. Ja jatkuu "
+           "vielä pitkään ilman taukoa mutta lopulta loppuu.\nRivi.")
+
+    def test_text_chunks(self):
+        """The chunks cover the text in order, each cut at a break if there is one"""
+        chunks = text_chunks(self.txt, 40)
+        self.assertEqual(chunks[0], (0, 28, True))  #after the paragraph break
+        self.assertEqual([paragraph for _, _, paragraph in chunks],
+                         [True, True, False, False])
+        self.assertEqual(chunks[-1][1], len(self.txt))
+        for (_, end, _), (start, _, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+        for start, end, _ in chunks:
+            self.assertLessEqual(end - start, 40)
+            self.assertGreater(end, start)
+
+    def test_short_text(self):
+        """A text shorter than max_char is one chunk, an empty one too"""
+        self.assertEqual(text_chunks(self.txt, 1000),
+                         [(0, len(self.txt), True)])
+        self.assertEqual(text_chunks("", 1000), [(0, 0, True)])
+
+    def test_stitch_chunks(self):
+        """Token ranges are shifted, sentences numbered on and the newdoc and a newpar inside a paragraph dropped"""
+
+        def chunk(form, end):
+            return (f"# newdoc\n# newpar\n# sent_id = 1\n# text = {form}\n"
+                    f"1\t{form}\t_\t_\t_\t_\t0\t_\t_\tTokenRange=0:{end}\n\n")
+
+        conllu, sent_id = stitch_chunks([(chunk("Eka", 3), 0, True),
+                                         (chunk("Toka", 4), 10, False),
+                                         (chunk("Kolmas", 6), 20, True)])
+        self.assertEqual(sent_id, 3)
+        self.assertEqual(
+            conllu, "# newdoc\n# newpar\n# sent_id = 1\n# text = Eka\n"
+            "1\tEka\t_\t_\t_\t_\t0\t_\t_\tTokenRange=0:3\n\n"
+            "# sent_id = 2\n# text = Toka\n"
+            "1\tToka\t_\t_\t_\t_\t0\t_\t_\tTokenRange=10:14\n\n"
+            "# newpar\n# sent_id = 3\n# text = Kolmas\n"
+            "1\tKolmas\t_\t_\t_\t_\t0\t_\t_\tTokenRange=20:26\n\n")
+        more, sent_id = stitch_chunks([(chunk("Neljäs", 6), 30, False)],
+                                      first=False,
+                                      sent_id=sent_id)
+        self.assertEqual(sent_id, 4)
+        self.assertTrue(more.startswith("# sent_id = 4\n"))
+
+    def test_large_job(self):
+        """A large text put in chunks is fetched whole, in order"""
+        txt = "".join(sentence(form) for form in forms)
+        p = Pipeline(["wipe_mod", "dummy_mod"], fuse=False, max_q_size=2)
+        try:
+            large_job_id = p.parse_large_txt(txt, 100)
+            conllu, finished = "", False
+            deadline = time.time() + 30
+            while not finished and time.time() < deadline:
+                part, finished = p.fetch_large_job(large_job_id)
+                conllu += part
+                time.sleep(0.01)
+            self.assertTrue(finished)
+            self.assertEqual(conllu, "".join(parsed(form) for form in forms))
+            self.assertEqual(p.report_large_job(large_job_id), [False])
+        finally:
+            p.send_final()
+
+    def test_large_job_put_failed(self):
+        """A chunk which could not be put fails the large job"""
+        txt = "".join(sentence(form) for form in forms)
+        p = Pipeline(["wipe_mod", "dummy_mod"], fuse=False, max_q_size=2)
+        put, chunks_put = p.put, []
+
+        def failing_put(txt, **kwargs):
+            if len(chunks_put) == 2:
+                raise RuntimeError("the pipeline is closing")
+            chunks_put.append(txt)
+            return put(txt, **kwargs)
+
+        p.put = failing_put
+        try:
+            large_job_id = p.parse_large_txt(txt, 100)
+            deadline = time.time() + 30
+            while (p.large_job(large_job_id).error is None
+                   and time.time() < deadline):
+                time.sleep(0.01)
+            with self.assertRaises(JobFailed):
+                p.report_large_job(large_job_id)
+            self.assertEqual(p.report_large_job(large_job_id), [False])  #forgotten
+        finally:
+            p.send_final()
+
+    def test_forget_large_job(self):
+        """A forgotten large job leaves nothing in the pipeline"""
+        txt = "".join(sentence(form) for form in forms)
+        p = Pipeline(["wipe_mod", "dummy_mod"], fuse=False, max_q_size=2)
+        try:
+            large_job_id = p.parse_large_txt(txt, 100)
+            p.forget_large_job(large_job_id)
+            deadline = time.time() + 30
+            while p.chars_in_flight and time.time() < deadline:  #the chunks inside are skipped
+                time.sleep(0.01)
+            self.assertEqual(p.chars_in_flight, 0)
+            self.assertEqual(p.jobs, {})
+        finally:
+            p.send_final()
+
+
+class TestParseBatched(unittest.TestCase):
+
+    def setUp(self):
+        self.p = Pipeline(["wipe_mod", "dummy_mod"], fuse=False)
+        self.lines_read = 0
+
+    def tearDown(self):
+        self.p.send_final()
+
+    def lines(self):
+        """The sentences of forms as CoNLL-U lines, counted as they are read"""
+        for form in forms:
+            for line in sentence(form).splitlines(keepends=True):
+                self.lines_read += 1
+                yield line
+
+    def parse_batched(self, **kwargs):
+        return self.p.parse_batched(self.lines(),
+                                    empty_line_batching=True,
+                                    batch_chars=0,
+                                    batch_tokens=1,
+                                    **kwargs)
+
+    def test_in_order(self):
+        """Each sentence is a batch, the results come in the input order"""
+        self.assertEqual(list(self.parse_batched()),
+                         [parsed(form) for form in forms])
+
+    def test_max_batches(self):
+        """No more than max_batches batches are in the pipeline at a time"""
+        in_flight = []
+        for _ in self.parse_batched(max_batches=3):
+            in_flight.append(len(self.p.jobs))
+            # a batch is cut at the first line of the next one
+            self.assertLessEqual(self.lines_read, 2 * (len(in_flight) + 3) + 1)
+        self.assertEqual(len(in_flight), len(forms))
+        self.assertLessEqual(max(in_flight), 3)
+
+    def test_close(self):
+        """Closing the generator early cancels the batches not yielded yet"""
+        results = self.parse_batched(max_batches=5)
+        self.assertEqual(next(results), parsed(forms[0]))
+        results.close()
+        self.assertEqual(self.p.jobs, {})
+        deadline = time.time() + 30
+        while self.p.chars_in_flight and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.p.chars_in_flight, 0)
+        self.assertLess(self.lines_read, 2 * len(forms))
+
+
+class TestRoutes(unittest.TestCase):
+
+    def test_plan_routes(self):
+        """A step shared by the pipelines is started once, after the steps feeding it"""
+        self.assertEqual(
+            plan_routes([["dummy_mod"], ["wipe_mod", "dummy_mod"],
+                         ["wipe_mod"]]), [("wipe_mod", "wipe_mod"),
+                                          ("dummy_mod", "dummy_mod")])
+
+    def test_step_twice(self):
+        """A pipeline cannot go through a step twice"""
+        with self.assertRaises(ValueError):
+            plan_routes([["wipe_mod", "dummy_mod", "wipe_mod"]])
+
+    def test_different_orders(self):
+        """Shared steps cannot be gone through in different orders"""
+        with self.assertRaises(ValueError):
+            plan_routes([["wipe_mod", "dummy_mod"], ["dummy_mod", "wipe_mod"]])
+
+    def test_pipelines(self):
+        """Each job goes through the pipeline it was put to"""
+        p = Pipeline({"full": ["wipe_mod", "dummy_mod"], "wipe": ["wipe_mod"]})
+        try:
+            self.assertEqual(p.parse(sentence(forms[0]), pipeline="full"),
+                             parsed(forms[0]))
+            self.assertEqual(
+                p.parse(sentence(forms[1]), pipeline="wipe"),
+                parsed(forms[1]).replace("\t0\t", "\t_\t"))
+            self.assertEqual(p.parse(sentence(forms[2])), parsed(forms[2]))
+            with self.assertRaises(KeyError):
+                p.put(sentence(forms[3]), pipeline="other")
+        finally:
+            p.send_final()
+
+
+class TestRoutingHints(unittest.TestCase):
+    """dummy_mod standing in for lemmatizer_mod, which has nothing to do on lemmas_filled"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, "lemma_cache.tsv")
+        with open(self.cache, "wt", encoding="utf8") as f:
+            f.write("Koira\tNOUN\t_\tkoira\n")
+        dummy_mod.skip_hints = lambda args: {"lemmas_filled"}
+
+    def tearDown(self):
+        del dummy_mod.skip_hints
+        shutil.rmtree(self.dir)
+
+    def run_pipeline(self, **kwargs):
+        p = Pipeline(
+            [f"lemma_cache_mod --lemma_cache {self.cache}", "dummy_mod"],
+            fuse=False,
+            metrics=True,
+            **kwargs)
+        try:
+            # the cache fills the lemmas of the first, dummy_mod skips it
+            self.assertEqual(
+                p.parse("1\tKoira\t_\tNOUN\t_\t_\t_\t_\t_\t_\n\n"),
+                "1\tKoira\tkoira\tNOUN\t_\t_\t_\t_\t_\t_\n\n")
+            self.assertEqual(
+                p.parse("1\tKissa\t_\tNOUN\t_\t_\t_\t_\t_\t_\n\n"),
+                "1\tKissa\t_\tNOUN\t_\t_\t0\t_\t_\t_\n\n")
+            lines = ['tnpp_stage_skipped_total{stage="dummy_mod"} 1',
+                     'tnpp_stage_jobs_total{stage="dummy_mod"} 1']
+            deadline = time.time() + 10
+            while (any(line not in p.metrics_text() for line in lines)
+                   and time.time() < deadline):  #reported by the step process
+                time.sleep(0.01)
+            for line in lines:
+                self.assertIn(line + "\n", p.metrics_text())
+        finally:
+            p.send_final()
+
+    def test_process(self):
+        """A job whose lemmas the cache filled bypasses the step process"""
+        self.run_pipeline()
+
+    def test_inprocess(self):
+        """A job whose lemmas the cache filled bypasses the stage"""
+        self.run_pipeline(mode="inprocess")
+
+
+class TestCpus(unittest.TestCase):
+
+    def test_parse_cpus(self):
+        """CPUs can be given as a number, a list or ranges"""
+        self.assertEqual(parse_cpus(3), {3})
+        self.assertEqual(parse_cpus("0-3,8"), {0, 1, 2, 3, 8})
+        self.assertEqual(parse_cpus([1, "4-5"]), {1, 4, 5})
+
+    def test_step_options(self):
+        """The threads and cpus of a step are parsed with its other options"""
+        options = step_config(dict(step="dummy_mod", threads="2",
+                                   cpus="0-1"))[1]
+        self.assertEqual(options["threads"], 2)
+        self.assertEqual(options["cpus"], {0, 1})
+
+
+def batches(batcher, lines):
+    """All the batches batcher cuts lines into"""
+    result = [batch for batch in map(batcher.add, lines) if batch is not None]
+    last = batcher.finish()
+    return result + [last] if last is not None else result
+
+
+class TestBatcher(unittest.TestCase):
+
+    text = [
+        "Eka rivi tässä.\n", "Toka rivi.\n", "\n", "###C: kommentti\n",
+        "Kolmas rivi on pidempi.\n", "Neljäs.\n"
+    ]
+    # the comment goes with the text after it
+    text_batches = [
+        "Eka rivi tässä.\nToka rivi.\n",
+        "\n###C: kommentti\nKolmas rivi on pidempi.\n", "Neljäs.\n"
+    ]
+
+    def test_lines(self):
+        """A batch is cut once it has more than batch_lines lines"""
+        self.assertEqual(
+            batches(Batcher(batch_lines=1, batch_chars=0), self.text),
+            self.text_batches)
+
+    def test_chars(self):
+        """A batch is cut once it has batch_chars characters"""
+        self.assertEqual(batches(Batcher(batch_chars=20), self.text),
+                         self.text_batches)
+
+    def test_tokens(self):
+        """A batch is cut once it has batch_tokens words"""
+        self.assertEqual(
+            batches(Batcher(batch_chars=0, batch_tokens=4), self.text),
+            self.text_batches)
+
+    def test_no_limit(self):
+        """Without limits the input is one batch"""
+        self.assertEqual(batches(Batcher(batch_chars=0), self.text),
+                         ["".join(self.text)])
+
+    def test_conllu(self):
+        """CoNLL-U is cut at empty lines only, never inside a sentence"""
+        rows = [
+            "1\tKoira\t_\t_\t_\t_\t_\t_\t_\t_\n",
+            "2\thaukkuu\t_\t_\t_\t_\t_\t_\t_\t_\n", "\n", "# text = Kissa\n",
+            "1\tKissa\t_\t_\t_\t_\t_\t_\t_\t_\n", "\n"
+        ]
+        self.assertEqual(
+            batches(
+                Batcher(batch_chars=0,
+                        batch_tokens=1,
+                        empty_line_batching=True), rows),
+            ["".join(rows[:3]), "".join(rows[3:])])
+
+    def test_no_text(self):
+        """Input with no text is no batch"""
+        self.assertEqual(batches(Batcher(), ["\n", "\n"]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
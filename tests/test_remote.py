@@ -0,0 +1,84 @@
+import multiprocessing
+import socket
+import unittest
+from tnparser.pipeline import Pipeline, JobFailed
+from tnparser.remote import Worker
+
+conllu = "1\tKoira\tkoira\tNOUN\t_\t_\t0\troot\t_\t_\n\n"
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(port, fail=False):
+    worker = Worker("dummy_mod", "127.0.0.1", port)
+    if fail:
+
+        def launch(args, q_in, q_out):
+            q_in.get()
+            raise RuntimeError("the model did not load")
+
+        worker.mod.launch = launch
+    worker.run()
+
+
+class TestRemoteStep(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.join()
+
+    def start_worker(self, fail=False):
+        worker = multiprocessing.Process(target=serve,
+                                         args=(self.port, fail),
+                                         daemon=True)
+        worker.start()
+        self.workers.append(worker)
+        return worker
+
+    def pipeline(self):
+        return Pipeline([
+            dict(step="dummy_mod",
+                 remote=f"tcp://127.0.0.1:{self.port}",
+                 remote_timeout="2")
+        ],
+                        fuse=False)
+
+    def test_parse(self):
+        """A job should come back from the worker as if the step ran locally"""
+        self.start_worker()
+        p = self.pipeline()
+        self.assertEqual(p.parse(conllu, timeout=30), conllu)
+        p.send_final()
+
+    def test_worker_restarted(self):
+        """The pipeline should reconnect to a worker started again on the same port"""
+        worker = self.start_worker()
+        p = self.pipeline()
+        self.assertEqual(p.parse(conllu, timeout=30), conllu)
+        worker.kill()
+        worker.join()
+        self.start_worker()
+        self.assertEqual(p.parse(conllu, timeout=30), conllu)
+        p.send_final()
+
+    def test_worker_failed(self):
+        """A step failing on the worker should fail the job, not hang the pipeline"""
+        self.start_worker(fail=True)
+        p = self.pipeline()
+        with self.assertRaises(JobFailed):
+            p.parse(conllu, timeout=60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from tnparser.streams import open_input, open_output, read_ahead
+
+lines = [f"{i}\tSana{i}\tsana\tNOUN\t_\t_\t0\troot\t_\t_\n" for i in range(3000)]
+
+
+class TestStreams(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def round_trip(self, name):
+        path = os.path.join(self.dir, name)
+        out = open_output(path)
+        out.writelines(lines)
+        out.close()
+        with open_input(path) as f:
+            return list(f)
+
+    def test_plain(self):
+        """A plain file is written and read as it is"""
+        self.assertEqual(self.round_trip("corpus.conllu"), lines)
+
+    def test_compressed(self):
+        """A file is compressed by its name ending and read back decompressed"""
+        for name, magic in (("corpus.conllu.gz", b"\x1f\x8b"),
+                            ("corpus.conllu.bz2", b"BZh"),
+                            ("corpus.conllu.xz", b"\xfd7zXZ\x00")):
+            with self.subTest(name=name):
+                self.assertEqual(self.round_trip(name), lines)
+                with open(os.path.join(self.dir, name), "rb") as f:
+                    self.assertTrue(f.read(6).startswith(magic))
+
+    def test_magic(self):
+        """Compressed input is recognized from its first bytes whatever its name"""
+        path = os.path.join(self.dir, "corpus.txt")
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.writelines(lines)
+        with open_input(path) as f:
+            self.assertEqual(list(f), lines)
+
+    def test_read_ahead(self):
+        """Every line comes through the reading thread, in order"""
+        self.assertEqual(list(read_ahead(iter(lines), lines=100, chunks=2)),
+                         lines)
+
+    def test_read_ahead_error(self):
+        """An error of the reading thread is raised in the consumer"""
+
+        def broken():
+            yield from lines[:10]
+            raise EOFError("truncated input")
+
+        with self.assertRaises(EOFError):
+            list(read_ahead(broken(), lines=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import queue
+import unittest
+from multiprocessing import shared_memory
+from tnparser.conllu import Document
+from tnparser.transport import SharedMemoryQueue, SharedPickle
+
+conllu = "".join(f"{i}\tSana{i}\tsana\tNOUN\t_\t_\t0\troot\t_\t_\n"
+                 for i in range(1, 100)) + "\n"
+
+
+class TestSharedMemoryQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = queue.Queue()
+        self.q = SharedMemoryQueue(self.raw, min_bytes=1000)
+
+    def round_trip(self, txt):
+        """txt put and got back through shared memory, its segment unlinked"""
+        self.q.put(("0-job", txt, 1.5))
+        handle = self.raw.queue[0][1]
+        self.assertIsInstance(handle, SharedPickle)
+        item = self.q.get()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=handle.name)
+        self.assertEqual(item[::2], ("0-job", 1.5))
+        return item[1]
+
+    def test_text(self):
+        """A text over min_bytes goes through a segment which get() frees"""
+        self.assertEqual(self.round_trip(conllu), conllu)
+
+    def test_short(self):
+        """A short text and a tombstone go through the queue itself"""
+        for txt in ["1\tSana\n\n", None]:
+            with self.subTest(txt=txt):
+                self.q.put(("0-job", txt))
+                self.assertNotIsInstance(self.raw.queue[0][1], SharedPickle)
+                self.assertEqual(self.q.get(), ("0-job", txt))
+
+    def test_document(self):
+        """A Document over min_bytes goes through a segment which get() frees"""
+        doc = self.round_trip(Document.from_conllu(conllu))
+        self.assertIsInstance(doc, Document)
+        self.assertEqual(doc.to_conllu(), conllu)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,38 +3,32 @@ import transformers
 import itertools
 import argparse
 import re
+from tnparser.conllu import Document
 
 ID, FORM, LEMMA, UPOS, XPOS, FEAT, HEAD, DEPREL, DEPS, MISC = range(10)
 
 
-def read_conllu(txt):
-    sent = []
-    comment = []
-    for line in txt.split("\n"):
-        line = line.strip()
-        if not line:  # new sentence
-            if sent:
-                yield comment, sent
-            comment = []
-            sent = []
-        elif line.startswith("#"):
-            comment.append(line)
-        else:  #normal line
-            cols = line.split("\t")
-            sent.append(cols)
-    else:
-        if sent:
-            yield comment, sent
+def split_text(txt, tokenizer, max_seq_len):
+    split_batch = []
+    for comment, sent in Document.ensure(txt).sentences():
+        split_sents = split(sent, tokenizer, max_seq_len)
+        split_batch.append((comment, split_sents[0]))
+        for ss in split_sents[1:]:
+            split_batch.append((["### TNPP MERGE INTO PREVIOUS"], ss))
+    return Document.from_sentences(split_batch)
+
 
+def merge_text(txt):
+    new_sents = merge(Document.ensure(txt).sentences())
+    return Document.from_sentences(new_sents)
 
-def format_conllu(sents):
-    res = []
-    for comments, sent in sents:
-        if comments:
-            res.extend(comments)
-        res.extend("\t".join(row) for row in sent)
-        res.append("")
-    return "\n".join(res) + "\n"
+
+def stage(args):
+    if args.merge:
+        return merge_text
+    tokenizer = transformers.BertTokenizer.from_pretrained(
+        args.vocabfile, local_files_only=True)
+    return lambda txt: split_text(txt, tokenizer, args.max_seq_len)
 
 
 def launch(args, q_in, q_out):
@@ -48,13 +42,7 @@ def launch(args, q_in, q_out):
             if jobid == "FINAL":
                 q_out.put((jobid, txt))
                 return
-            split_batch = []
-            for comment, sent in read_conllu(txt):
-                split_sents = split(sent, tokenizer, max_seq_len)
-                split_batch.append((comment, split_sents[0]))
-                for ss in split_sents[1:]:
-                    split_batch.append((["### TNPP MERGE INTO PREVIOUS"], ss))
-            q_out.put((jobid, format_conllu(split_batch)))
+            q_out.put((jobid, split_text(txt, tokenizer, max_seq_len)))
     else:
         #our job is to merge
         while True:
@@ -62,8 +50,24 @@ def launch(args, q_in, q_out):
             if jobid == "FINAL":
                 q_out.put((jobid, txt))
                 return
-            new_sents = list(merge(read_conllu(txt)))
-            q_out.put((jobid, format_conllu(new_sents)))
+            q_out.put((jobid, merge_text(txt)))
+
+
+def routing_hints(args, txt):
+    """bert512_unchanged: the split left every sentence and token as it was, the merge has nothing to undo"""
+    if args.merge:
+        return set()
+    doc = Document.ensure(txt)
+    if any(comments == ["### TNPP MERGE INTO PREVIOUS"]
+           for comments in doc.comments) or any(
+               "BERT512TRUNCATEDTOKEN_ORIG=" in misc
+               for misc in doc.cols[MISC]):
+        return set()
+    return {"bert512_unchanged"}
+
+
+def skip_hints(args):
+    return {"bert512_unchanged"} if args.merge else set()
 
 
 def grouper(iterable, n, fillvalue=None):
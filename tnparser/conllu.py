@@ -0,0 +1,170 @@
+import sys
+
+ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
+
+# columns with a small closed set of values, kept as interned strings
+INTERNED = (UPOS, XPOS, FEATS, DEPREL, DEPS)
+# free text columns, pickled as one string each
+TEXT = (ID, FORM, LEMMA, HEAD, MISC)
+
+
+class Document:
+    """
+    A CoNLL-U document kept column-wise so that it can be handed from one
+    pipeline step to the next without printing and re-parsing the text:
+    cols[c][i] is column c of row i, sentence s spans the rows
+    sent_offsets[s]:sent_offsets[s+1] and has the comment lines comments[s]
+    """
+
+    def __init__(self):
+        self.cols = [[] for _ in range(10)]
+        self.sent_offsets = [0]
+        self.comments = []
+
+    @classmethod
+    def from_conllu(cls, txt):
+        """
+        Parse CoNLL-U text, comments after the last sentence are dropped,
+        a row with fewer than 10 columns is filled up with _ and one with
+        more is cut to 10, so it does not take the others with it
+        """
+        doc = cls()
+        rows = []
+        comments = []
+        for line in txt.split("\n"):
+            line = line.strip(" \r")  #not tabs, MISC may be empty
+            if not line.strip():  # new sentence
+                if len(rows) > doc.sent_offsets[-1]:
+                    doc.sent_offsets.append(len(rows))
+                    doc.comments.append(comments)
+                    comments = []
+            elif line.startswith("#"):
+                comments.append(line)
+            else:
+                row = line.split("\t")
+                if len(row) != 10:
+                    row = (row + ["_"] * 10)[:10]
+                rows.append(row)
+        if len(rows) > doc.sent_offsets[-1]:
+            doc.sent_offsets.append(len(rows))
+            doc.comments.append(comments)
+        if rows:
+            doc.cols = [list(col) for col in zip(*rows)]
+        for c in INTERNED:
+            doc.cols[c] = [sys.intern(v) for v in doc.cols[c]]
+        return doc
+
+    @classmethod
+    def ensure(cls, data):
+        """data: CoNLL-U text or a Document coming from the previous step"""
+        if isinstance(data, cls):
+            return data
+        return cls.from_conllu(data)
+
+    @classmethod
+    def from_sentences(cls, sentences):
+        """sentences: iterable of (comments, list of rows) as sentences() yields them"""
+        doc = cls()
+        rows = []
+        pending = []  # comments of an empty sentence go to the next one, as in text
+        for comments, sent in sentences:
+            pending.extend(comments)
+            if not sent:
+                continue
+            rows.extend(sent)
+            doc.sent_offsets.append(len(rows))
+            doc.comments.append(pending)
+            pending = []
+        if rows:
+            doc.cols = [list(col) for col in zip(*rows)]
+        return doc
+
+    @classmethod
+    def concat(cls, docs):
+        """One Document with the sentences of all docs, in order"""
+        doc = cls()
+        for d in docs:
+            shift = doc.sent_offsets[-1]
+            for col, other in zip(doc.cols, d.cols):
+                col.extend(other)
+            doc.sent_offsets.extend(o + shift for o in d.sent_offsets[1:])
+            doc.comments.extend(d.comments)
+        return doc
+
+    def split(self, counts):
+        """Cut into Documents of counts[0], counts[1], ... sentences, the inverse of concat()"""
+        docs = []
+        s = 0
+        for count in counts:
+            start, end = self.sent_offsets[s], self.sent_offsets[s + count]
+            doc = Document()
+            doc.cols = [col[start:end] for col in self.cols]
+            doc.sent_offsets = [o - start for o in self.sent_offsets[s:s + count + 1]]
+            doc.comments = self.comments[s:s + count]
+            docs.append(doc)
+            s += count
+        return docs
+
+    def __len__(self):
+        """Number of sentences"""
+        return len(self.comments)
+
+    def num_rows(self):
+        return self.sent_offsets[-1]
+
+    def sentence_ranges(self):
+        """Yield (comments, start, end) row ranges of every sentence"""
+        for comments, start, end in zip(self.comments, self.sent_offsets,
+                                        self.sent_offsets[1:]):
+            yield comments, start, end
+
+    def sentences(self):
+        """Yield (comments, rows) with every row as a fresh list of 10 columns"""
+        rows = self.rows()
+        for comments, start, end in self.sentence_ranges():
+            yield comments, rows[start:end]
+
+    def rows(self):
+        return [list(row) for row in zip(*self.cols)]
+
+    def is_word(self, i):
+        """Row i is a syntactic word, not a multiword token or an empty node"""
+        return self.cols[ID][i].isdigit()
+
+    def to_conllu(self):
+        lines = ["\t".join(row) for row in zip(*self.cols)]
+        res = []
+        for comments, start, end in self.sentence_ranges():
+            res.extend(comments)
+            res.extend(lines[start:end])
+            res.append("")
+        return "\n".join(res) + "\n" if res else ""
+
+    def __getstate__(self):
+        # the free text columns go as one string each, the interned ones as
+        # lists: pickle writes each distinct interned value once and refers
+        # back to it, which is several times cheaper than 10 lists of str
+        return {
+            "text": {c: "\n".join(self.cols[c])
+                     for c in TEXT},
+            "interned": {c: self.cols[c]
+                         for c in INTERNED},
+            "sent_offsets": self.sent_offsets,
+            "comments": self.comments
+        }
+
+    def __setstate__(self, state):
+        self.sent_offsets = state["sent_offsets"]
+        self.comments = state["comments"]
+        self.cols = [None] * 10
+        for c, txt in state["text"].items():
+            self.cols[c] = txt.split("\n") if self.sent_offsets[-1] else []
+        for c, values in state["interned"].items():
+            self.cols[c] = values
+
+
+def to_conllu(data):
+    """CoNLL-U text of what a pipeline step produced, a Document or text"""
+    if isinstance(data, Document):
+        return data.to_conllu()
+    return data
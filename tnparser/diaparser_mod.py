@@ -10,55 +10,65 @@ from tempfile import NamedTemporaryFile
 
 from diaparser.parsers import Parser
 
+from tnparser.conllu import Document
 
-ID,FORM,LEMMA,UPOS,XPOS,FEAT,HEAD,DEPREL,DEPS,MISC=range(10)
 
-def read_conllu(txt):
-    sent=[]
-    comment=[]
-    for line in txt.split("\n"):
-        line=line.strip()
-        if not line: # new sentence
-            if sent:
-                yield comment,sent
-            comment=[]
-            sent=[]
-        elif line.startswith("#"):
-            comment.append(line)
-        else: #normal line
-            cols=line.split("\t")
-            sent.append(cols)
-    else:
-        if sent:
-            yield comment, sent
+ID,FORM,LEMMA,UPOS,XPOS,FEAT,HEAD,DEPREL,DEPS,MISC=range(10)
 
-def conllu2dataset(conllu):
+def conllu2dataset(doc):
     dset=[]
-    all_comments=[]
-    all_sentences=[]
-    for comments,sent in read_conllu(conllu):
-        tokens=[line[FORM] for line in sent if line[ID].isdigit()] #gather only those tokens you really want to parse
-        dset.append(tokens)
-        all_comments.append(comments)
-        all_sentences.append(sent)
-    return all_comments,all_sentences,dset
+    all_word_rows=[]
+    for comments,start,end in doc.sentence_ranges():
+        word_rows=[i for i in range(start,end) if doc.is_word(i)] #gather only those tokens you really want to parse
+        dset.append([doc.cols[FORM][i] for i in word_rows])
+        all_word_rows.append(word_rows)
+    return all_word_rows,dset
 
-def merge(comments,sent,parser_out_sent):
-    i=0
-    for row in sent:
-        if row[ID].isdigit():
-            row[HEAD]=str(parser_out_sent.values[HEAD][i])
-            row[DEPREL]=parser_out_sent.values[DEPREL][i]
-            i+=1
-    if comments:
-        result="\n".join(comments)+"\n"
-    else:
-        result=""
-    result+="\n".join("\t".join(row) for row in sent)
-    result+="\n\n"
-    return result
+def merge(doc,word_rows,parser_out_sent):
+    heads=doc.cols[HEAD]
+    deprels=doc.cols[DEPREL]
+    for i,row in enumerate(word_rows):
+        heads[row]=str(parser_out_sent.values[HEAD][i])
+        deprels[row]=sys.intern(parser_out_sent.values[DEPREL][i])
     
 
+def length_batches(dset,max_tokens):
+    """
+    Indices of the sentences of dset grouped into batches of similar length,
+    each at most max_tokens tokens counting the padding to its longest sentence
+    (a longer sentence goes alone)
+    """
+    order=sorted(range(len(dset)),key=lambda i:len(dset[i]),reverse=True)
+    batch=[]
+    for i in order:
+        if batch and (len(batch)+1)*len(dset[batch[0]])>max_tokens: #batch[0] is the longest
+            yield batch
+            batch=[]
+        batch.append(i)
+    if batch:
+        yield batch
+
+def parse_text(parser,txt,batch_size=1000):
+    doc=Document.ensure(txt)
+    word_rows,dset=conllu2dataset(doc)
+    predicted=[None]*len(dset)
+    try:
+        for batch in length_batches(dset,batch_size):
+            # the batch is already of one length bucket, no need for the kmeans of predict()
+            out=parser.predict([dset[i] for i in batch],batch_size=batch_size,buckets=1)
+            for i,parser_out in zip(batch,out.sentences):
+                predicted[i]=parser_out
+    except:
+        print("This batch has caused an exception. Here it is json-encoded:",json.dumps([sent for comm,sent in doc.sentences()],ensure_ascii=False),file=sys.stderr)
+        raise
+    for rows,parser_out in zip(word_rows,predicted): #back in the original order
+        merge(doc,rows,parser_out)
+    return doc
+
+def stage(args):
+    parser = Parser.load(args.model)
+    return lambda txt: parse_text(parser,txt,args.batch_size)
+
 def launch(args, q_in, q_out):
     try:
         parser = Parser.load(args.model)
@@ -71,25 +81,23 @@ def launch(args, q_in, q_out):
             q_out.put((jobid,txt))
             return
         try:
-            comments,sents,dset=conllu2dataset(txt)
-            try:
-                predicted=parser.predict(dset,batch_size=1000)
-            except:
-                print("This batch has caused an exception. Here it is json-encoded:",json.dumps(sents,ensure_ascii=False),file=sys.stderr)
-                raise
-            res=[]
-            for comm,sent,parser_out in zip(comments,sents,predicted.sentences):
-                res.append(merge(comm,sent,parser_out))
-            q_out.put((jobid,"".join(res)))
+            q_out.put((jobid,parse_text(parser,txt,args.batch_size)))
         except:
             traceback.print_exc()
             sys.stderr.flush()
             raise
+
+def batch_tokens(args):
+    """Tokens in one prediction batch, for the input batching of the streaming CLIs"""
+    return args.batch_size
             
+coalescable=True #sentences are parsed independently, several jobs can share one predict()
+multithreaded=True #torch, runs a thread pool sized by Pipeline(cpu_threads=...) or the threads option
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument("--model", type=str, help="The model file")
 argparser.add_argument("--device", default=0, type=int, help="CUDA device number; set to -1 for CPU")
-argparser.add_argument("--batch_size", default=128, type=int, help="The size of each prediction batch")
+argparser.add_argument("--batch_size", default=1000, type=int, help="Tokens in each prediction batch, counting the padding, sentences are batched by length. Default %(default)d")
 argparser.add_argument("--lazy", action="store_true", help="Lazy load dataset")
 argparser.add_argument("--raw_text", action="store_true", help="Input raw sentences, one per line in the input file.")
         
@@ -4,6 +4,7 @@ import argparse
 import time
 import re
 import traceback
+from tnparser.conllu import Document
 
 ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
 
@@ -19,20 +20,19 @@ def launch(args, q_in, q_out):
         except:
             traceback.print_exc()
             sys.stderr.flush()
+            raise
     
 def parse_text(txt):
-    lines = []
-    for line in txt.split("\n"):
-        line = line.strip()
-        if not line or line.startswith("#"):
-            lines.append(line)
-        else:
-            cols = line.split("\t")
-            cols[HEAD] = "0"
-            lines.append("\t".join(cols))
-            
-    return "\n".join(lines)
+    doc = Document.ensure(txt)
+    doc.cols[HEAD] = ["0"] * doc.num_rows()
+    return doc
+
+def stage(args):
+    return parse_text
     
+fusable=True
+coalescable=True
+
 argparser = argparse.ArgumentParser(description='writer as a process')
 
 
@@ -7,31 +7,13 @@ import urllib
 # import dummy_handler
 import argparse
 import re
+from tnparser.conllu import Document
 
 ID,FORM,LEMMA,UPOS,XPOS,FEAT,HEAD,DEPREL,DEPS,MISC=range(10)
 
 url_regex = re.compile("((https?|ftp)://|www\.)", re.IGNORECASE)
 email_regex = re.compile("[^@,:]+@[^@,:]+\.[^@,:]+", re.IGNORECASE)
 
-def read_conllu(f):
-    sent=[]
-    comment=[]
-    for line in f:
-        line=line.strip()
-        if not line: # new sentence
-            if sent:
-                yield comment,sent
-            comment=[]
-            sent=[]
-        elif line.startswith("#"):
-            comment.append(line)
-        else: #normal line
-            sent.append(line.split("\t"))
-    else:
-        if sent:
-            yield comment, sent
-
-
 class LemmaCacheWrapper():
 
     def __init__(self, args):
@@ -61,44 +43,36 @@ class LemmaCacheWrapper():
 
     def lemmatize_batch(self, conllu_batch):
 
-        output_lines=[]
+        doc=Document.ensure(conllu_batch)
+        ids,forms,lemmas,upos,feats=(doc.cols[c] for c in (ID,FORM,LEMMA,UPOS,FEAT))
         lemmatized=0
         token_counter=0
         filled=0
-        for (comm, sent) in read_conllu(conllu_batch.split("\n")):
-            for c in comm:
-                output_lines.append(c)
-            for cols in sent:
-                if "-" in cols[ID]: # multiword token line, not supposed to be analysed
-                    output_lines.append("\t".join(t for t in cols))
-                    continue
-                token_counter+=1
-                if cols[LEMMA]!="_": # already filled in for example by another module, do not process
-                    cols[LEMMA]="_"
-                #    output_lines.append("\t".join(t for t in cols))
-                #    filled+=1
-                #    continue
-                token_data=(cols[FORM],cols[UPOS],cols[FEAT])
-                if token_data in self.cache:
-                    plemma=self.cache[token_data]
-                    if plemma.strip()=="":
-                        plemma="_" # make sure not to output empty lemma
-                    cols[LEMMA]=plemma
-                    output_lines.append("\t".join(t for t in cols))
-                    lemmatized+=1
-                    continue
-                if self.lemmatize_url_and_email==False and self.is_url_or_email(cols[FORM]): # simple copy
-                    cols[LEMMA]=cols[FORM]
-                    output_lines.append("\t".join(t for t in cols))
-                    lemmatized+=1
-                    continue
-
-                # lemma not in cache, pass empty lemma for next module
-                output_lines.append("\t".join(t for t in cols))
-            output_lines.append("")
+        for i in range(doc.num_rows()):
+            if "-" in ids[i]: # multiword token line, not supposed to be analysed
+                continue
+            token_counter+=1
+            if lemmas[i]!="_": # already filled in for example by another module, do not process
+                lemmas[i]="_"
+            #    filled+=1
+            #    continue
+            token_data=(forms[i],upos[i],feats[i])
+            if token_data in self.cache:
+                plemma=self.cache[token_data]
+                if plemma.strip()=="":
+                    plemma="_" # make sure not to output empty lemma
+                lemmas[i]=plemma
+                lemmatized+=1
+                continue
+            if self.lemmatize_url_and_email==False and self.is_url_or_email(forms[i]): # simple copy
+                lemmas[i]=forms[i]
+                lemmatized+=1
+                continue
+
+            # lemma not in cache, pass empty lemma for next module
         print(" >>> {}/{} lemmas already filled before lemma cache module".format(filled,token_counter),file=sys.stderr)
         print(" >>> {}/{} lemmatized with lemma cache".format(lemmatized,token_counter),file=sys.stderr)
-        return "\n".join(output_lines)+"\n"
+        return doc
 
             
     def parse_text(self,conllu):
@@ -108,6 +82,9 @@ class LemmaCacheWrapper():
     
 
 
+def stage(args):
+    return LemmaCacheWrapper(args).parse_text
+
 def launch(args,q_in,q_out):
     lemma_cache=LemmaCacheWrapper(args)
     while True:
@@ -118,6 +95,15 @@ def launch(args,q_in,q_out):
             return
         q_out.put((jobid,lemma_cache.parse_text(txt)))
 
+def routing_hints(args,txt):
+    """lemmas_filled: the cache knew every lemma, nothing left for lemmatizer_mod"""
+    doc=Document.ensure(txt)
+    if all(lemma!="_" or "-" in i for i,lemma in zip(doc.cols[ID],doc.cols[LEMMA])):
+        return {"lemmas_filled"}
+    return set()
+
+fusable=True
+
 argparser = argparse.ArgumentParser(description='Lemmatize conllu text using precomputed lemma cache (comes together with the actual lemma model)')
 argparser.add_argument('--lemma_cache', type=str, default='', help='Lemma cache file')
 argparser.add_argument('--lemmatize_url_and_email', action="store_true", default=False, help='Lemmatize also URLs and emails (default: False -- copy form into lemma field)')
@@ -15,28 +15,12 @@ from onmt.model_builder import build_base_model
 import torch
 from onmt.translate import Translator
 
+from tnparser.conllu import Document
+
 
 ID,FORM,LEMMA,UPOS,XPOS,FEATS,HEAD,DEPREL,DEPS,MISC=range(10)
 WHITESPACE_MARKER = "$@@$"
 
-def read_conllu(f):
-    sent=[]
-    comment=[]
-    for line in f:
-        line=line.strip()
-        if not line: # new sentence
-            if sent:
-                yield comment,sent
-            comment=[]
-            sent=[]
-        elif line.startswith("#"):
-            comment.append(line)
-        else: #normal line
-            sent.append(line.split("\t"))
-    else:
-        if sent:
-            yield comment, sent
-
 class Lemmatizer(object):
 
     def __init__(self):
@@ -135,23 +119,22 @@ class Lemmatizer(object):
         submitted_tdata=[] #list of token data entries submitted for lemmatization
 
         # lemmatize data_batch
-        original_sentences=[]
+        doc=Document.ensure(data_batch)
+        ids,forms,lemmas,upos,feats=(doc.cols[c] for c in (ID,FORM,LEMMA,UPOS,FEATS))
         translate_input=[]
         token_counter=0
-        for (comm, sent) in read_conllu(data_batch.split("\n")):
-            original_sentences.append((comm, sent))
-            for token in sent:
-                if "-" in token[ID]: # multiword token line, not supposed to be analysed
-                    continue
-                token_counter+=1
-                if token[LEMMA]!="_": # already filled in for example by another module, do not process
-                    continue
-                token_data=(token[FORM],token[UPOS],token[FEATS])
-                if token_data not in self.localcache and token_data not in submitted:
-                    submitted.add(token_data)
-                    submitted_tdata.append(token_data)
-                    form, _ = self.transform_token(token)
-                    translate_input.append(form)
+        for i in range(doc.num_rows()):
+            if "-" in ids[i]: # multiword token line, not supposed to be analysed
+                continue
+            token_counter+=1
+            if lemmas[i]!="_": # already filled in for example by another module, do not process
+                continue
+            token_data=(forms[i],upos[i],feats[i])
+            if token_data not in self.localcache and token_data not in submitted:
+                submitted.add(token_data)
+                submitted_tdata.append(token_data)
+                form, _ = self.transform_token([c[i] for c in doc.cols])
+                translate_input.append(form)
         print(" >>> {}/{} unique tokens submitted to lemmatizer".format(len(submitted_tdata),token_counter),file=sys.stderr)
         # run lemmatizer if everything is not in cache
         if len(submitted_tdata)>0:
@@ -163,27 +146,20 @@ class Lemmatizer(object):
             for tdata,predicted_lemma in zip(submitted_tdata,lemm_output):
                 predicted_lemma=self.detransform_string(predicted_lemma.strip())
                 self.localcache[tdata]=predicted_lemma
-        output_lines=[]
-        for comm, sent in original_sentences:
-            for c in comm:
-                output_lines.append(c)
-            for cols in sent:
-                if "-" in cols[ID] or cols[LEMMA]!="_": # multiword token line or lemma already predicted, not supposed to be analysed
-                    output_lines.append("\t".join(t for t in cols))
-                    continue
-                token_data=(cols[FORM],cols[UPOS],cols[FEATS])
-                if token_data in self.localcache:
-                    plemma=self.localcache[token_data]
-                else:
-                    assert False, ("Missing lemma", token_data)
-                if plemma.strip()=="":
-                    plemma="_" # make sure not to output empty lemma
-                cols[LEMMA]=plemma
-                output_lines.append("\t".join(t for t in cols))
-            output_lines.append("")
-
-
-        return "\n".join(output_lines)+"\n"
+        for i in range(doc.num_rows()):
+            if "-" in ids[i] or lemmas[i]!="_": # multiword token line or lemma already predicted, not supposed to be analysed
+                continue
+            token_data=(forms[i],upos[i],feats[i])
+            if token_data in self.localcache:
+                plemma=self.localcache[token_data]
+            else:
+                assert False, ("Missing lemma", token_data)
+            if plemma.strip()=="":
+                plemma="_" # make sure not to output empty lemma
+            lemmas[i]=plemma
+
+
+        return doc
 
 
     def transform_token(self, cols):
@@ -229,6 +205,9 @@ class LemmatizerWrapper():
         result_conllu=self.lemmatizer_model.lemmatize_batch(conllu)
         return result_conllu
 
+def stage(args):
+    return LemmatizerWrapper(args).parse_text
+
 def launch(args,q_in,q_out):
 
     lemmatizer=LemmatizerWrapper(args)
@@ -240,6 +219,12 @@ def launch(args,q_in,q_out):
             return
         q_out.put((jobid,lemmatizer.parse_text(txt)))
 
+def skip_hints(args):
+    return {"lemmas_filled"} # see lemma_cache_mod
+
+coalescable=True
+multithreaded=True #torch, runs a thread pool sized by Pipeline(cpu_threads=...) or the threads option
+
 argparser = argparse.ArgumentParser(description='Lemmatize conllu text')
 argparser.add_argument('--model', default='models/lemmatizer.pt', type=str, help='Model')
 argparser.add_argument('--device', type=int, default=0, help='Deprecated, uses GPU if available.')
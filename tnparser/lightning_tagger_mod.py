@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import numpy
 from tnparser.lightning_tagger.data import ConlluData, TaggerDataModule
 from tnparser.lightning_tagger.model import TaggerModel
+from tnparser.conllu import Document
 import os
 import pickle
 import logging
@@ -50,6 +51,31 @@ def predict_batch(model, dataset, label_encoders):
     return batch_labels
 
 
+def tag_text(txt, tagger, label_encoders, datareader, batch_size):
+    # prepare dataset
+    sentences = list(Document.ensure(txt).sentences())
+    data = datareader.data2dict(sentences)
+    dataset = TaggerDataModule(tagger.tokenizer, label_encoders, batch_size)
+    dataset.prepare_data(data, stage="predict")
+    dataset.setup("predict")
+    
+    # predict
+    batch_labels = predict_batch(tagger, dataset, label_encoders)
+    for sent_idx, labels in batch_labels.items():
+        _, sent = sentences[sent_idx]
+        for key, predicted in labels.items():
+            col = datareader.column_to_label_map_inv[key]
+            for token, value in zip(sent, predicted):
+                token[col] = sys.intern(str(value)) # numpy.str_ would not pickle compactly
+    return Document.from_sentences(sentences)
+
+
+def stage(args):
+    tagger, label_encoders = load_model(args)
+    datareader = ConlluData()
+    return lambda txt: tag_text(txt, tagger, label_encoders, datareader, args.batch_size)
+
+
 def launch(args, q_in, q_out):
     try:
         tagger, label_encoders = load_model(args)
@@ -63,28 +89,16 @@ def launch(args, q_in, q_out):
             q_out.put((jobid,txt))
             return
         try:
-            # prepare dataset
-            sentences = []
-            for comm, sent in datareader.read_conllu(txt):
-                sentences.append((comm, sent))
-            data = datareader.data2dict(sentences)
-            dataset = TaggerDataModule(tagger.tokenizer, label_encoders, args.batch_size)
-            dataset.prepare_data(data, stage="predict")
-            dataset.setup("predict")
-            
-            # predict
-            batch_labels = predict_batch(tagger, dataset, label_encoders)
-            pred = []
-            for sent_idx, labels in batch_labels.items():
-                conllu = datareader.write_predictions(data, labels, sent_idx)
-                pred += conllu
-            q_out.put((jobid,"\n".join(pred)))
+            q_out.put((jobid,tag_text(txt, tagger, label_encoders, datareader, args.batch_size)))
         except:
             traceback.print_exc()
             sys.stderr.flush()
             raise
     
 
+coalescable=True #jobs can be tagged as one batch
+multithreaded=True #torch, runs a thread pool sized by Pipeline(cpu_threads=...) or the threads option
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument('--bert_pretrained', type=str, default='TurkuNLP/bert-base-finnish-cased-v1')
 argparser.add_argument('--batch_size', type=int, default=16)
@@ -0,0 +1,208 @@
+import re
+import time
+import threading
+
+from tnparser.conllu import Document, ID
+
+token_regex = re.compile("^[0-9]+\t", re.M)
+tree_regex = re.compile("^1\t", re.M)
+
+# upper bounds of the histogram buckets, seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+def measure(data):
+    """(characters, sentences, tokens) of a job text or Document"""
+    if isinstance(data, Document):
+        chars = sum(sum(map(len, col)) for col in data.cols)
+        chars += data.num_rows() * 10 + sum(
+            sum(map(len, c)) + len(c) for c in data.comments)
+        tokens = sum(1 for i in data.cols[ID] if i.isdigit()) if len(data) else 0
+        return chars, len(data), tokens
+    return len(data), len(tree_regex.findall(data)), len(
+        token_regex.findall(data))
+
+
+class MeteredIn:
+    """
+    Input queue of a step as seen by its launch(), times every job it hands
+    out if step is given and reports ("take", proc, jobid) if proc is given
+    """
+
+    def __init__(self, queue, step, proc, events):
+        self.queue = queue
+        self.step = step
+        self.proc = proc
+        self.events = events
+        self.started = {}  # jobid -> (time taken from the queue, queue wait, chars in)
+
+    def get(self, block=True, timeout=None):
+        item = self.queue.get(block, timeout)
+        jobid, txt = item[:2]
+        now = time.time()
+        if jobid != "FINAL" and txt is not None:  #None: a dropped job, see output_mod
+            if self.proc is not None:
+                self.events.put(("take", self.proc, jobid))
+            waited = now - item[2] if len(item) > 2 else None
+            self.started[jobid] = (now, waited,
+                                   measure(txt)[0] if self.step else 0)
+        return jobid, txt
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+class MeteredOut:
+    """
+    Output queue of a step, reports ("done", step, stats) for each finished
+    job if step is given and ("out", proc, jobid) if proc is given, and
+    stamps the job for the next step
+    """
+
+    def __init__(self, queue, metered_in):
+        self.queue = queue
+        self.metered_in = metered_in
+
+    def put(self, item, block=True, timeout=None):
+        jobid, txt = item[:2]
+        now = time.time()
+        metered_in = self.metered_in
+        started = metered_in.started.pop(jobid, None)
+        if started is not None and metered_in.proc is not None:  #before the next step can take it
+            metered_in.events.put(("out", metered_in.proc, jobid))
+        if started is not None and metered_in.step:
+            chars, sentences, tokens = measure(txt)
+            t_start, waited, chars_in = started
+            metered_in.events.put(
+                ("done", metered_in.step,
+                 (now - t_start, waited, chars_in, chars, sentences, tokens)))
+        self.queue.put((jobid, txt, now), block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+
+def launch_metered(target, step, proc, events, args, q_in, q_out):
+    """Process target running target(args, q_in, q_out) with metered queues"""
+    metered_in = MeteredIn(q_in, step, proc, events)
+    return target(args, metered_in, MeteredOut(q_out, metered_in))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class StageStats:
+    def __init__(self):
+        self.jobs = 0
+        self.sentences = 0
+        self.tokens = 0
+        self.chars_in = 0
+        self.chars_out = 0
+        self.skipped = 0
+        self.processing = Histogram()
+        self.queue_wait = Histogram()
+
+
+class Metrics:
+    """Per step counters and histograms of a Pipeline, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}  # step name -> StageStats
+        self.queues = {}  # step name -> its input queue, for the depth
+
+    def add_step(self, step, q_in=None):
+        with self.lock:
+            self.stats.setdefault(step, StageStats())
+            if q_in is not None:
+                self.queues[step] = q_in
+
+    def record(self, step, processing, waited, chars_in, chars_out, sentences,
+               tokens):
+        with self.lock:
+            stats = self.stats.setdefault(step, StageStats())
+            stats.jobs += 1
+            stats.sentences += sentences
+            stats.tokens += tokens
+            stats.chars_in += chars_in
+            stats.chars_out += chars_out
+            stats.processing.observe(processing)
+            if waited is not None:
+                stats.queue_wait.observe(max(waited, 0.0))
+
+    def record_skip(self, step):
+        with self.lock:
+            self.stats.setdefault(step, StageStats()).skipped += 1
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP tnpp_stage_{name} {help_text}")
+            lines.append(f"# TYPE tnpp_stage_{name} {kind}")
+            lines.extend(values)
+
+        def label(step):
+            return 'stage="{}"'.format(
+                step.replace("\\", "\\\\").replace('"', '\\"'))
+
+        def counter(name, help_text, attr):
+            metric(name, "counter", help_text, [
+                f"tnpp_stage_{name}{{{label(step)}}} {getattr(stats, attr)}"
+                for step, stats in self.stats.items()
+            ])
+
+        def histogram(name, help_text, attr):
+            values = []
+            for step, stats in self.stats.items():
+                h = getattr(stats, attr)
+                for bound, count in zip(BUCKETS, h.counts):
+                    values.append(
+                        f'tnpp_stage_{name}_bucket{{{label(step)},le="{bound}"}} {count}'
+                    )
+                values.append(
+                    f'tnpp_stage_{name}_bucket{{{label(step)},le="+Inf"}} {h.count}'
+                )
+                values.append(f"tnpp_stage_{name}_sum{{{label(step)}}} {h.sum}")
+                values.append(
+                    f"tnpp_stage_{name}_count{{{label(step)}}} {h.count}")
+            metric(name, "histogram", help_text, values)
+
+        with self.lock:
+            counter("jobs_total", "Jobs processed by the step", "jobs")
+            counter("skipped_total",
+                    "Jobs passed on unprocessed, the step had nothing to do",
+                    "skipped")
+            counter("sentences_total", "Sentences output by the step",
+                    "sentences")
+            counter("tokens_total", "Tokens output by the step", "tokens")
+            counter("input_chars_total", "Characters of CoNLL-U or text read by the step",
+                    "chars_in")
+            counter("output_chars_total", "Characters of CoNLL-U output by the step",
+                    "chars_out")
+            histogram("processing_seconds", "Time spent on one job",
+                      "processing")
+            histogram("queue_wait_seconds",
+                      "Time a job waited in the input queue of the step",
+                      "queue_wait")
+            depths = []
+            for step, q in self.queues.items():
+                try:
+                    depths.append(
+                        f"tnpp_stage_queue_depth{{{label(step)}}} {q.qsize()}")
+                except NotImplementedError:  #no qsize() on macOS
+                    pass
+            metric("queue_depth", "gauge",
+                   "Jobs waiting in the input queue of the step", depths)
+        return "\n".join(lines) + "\n"
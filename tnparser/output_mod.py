@@ -3,20 +3,70 @@ import io
 import argparse
 import time
 import re
+from tnparser.conllu import to_conllu
+from tnparser.streams import open_output
 
 token_regex=re.compile("[0-9]+\t")
 
+def stage(args):
+    out=open_output(args.output)
+    def print_text(txt):
+        txt=to_conllu(txt)
+        out.write(txt)
+        out.flush() #no FINAL in process, nothing tells when the last one came
+        return txt
+    return print_text
+
+def job_seq(jobid):
+    """Sequence number of a Pipeline job id "seq-hash", None for other ids"""
+    seq=jobid.split("-",1)[0]
+    return int(seq) if seq.isdigit() else None
+
+def in_order(q_in):
+    """
+    Yield the jobs of q_in in the order they were put into the pipeline: a job
+    replayed after a crash is printed in its place, a (jobid, None) tombstone
+    stands for a job which was dropped
+    """
+    waiting={} # seq -> (jobid, txt) arrived ahead of their turn
+    next_seq=0 # Pipeline numbers the jobs it sends to the processes from 0
+    while True:
+        jobid,txt=q_in.get()
+        seq=job_seq(jobid) if jobid!="FINAL" else None
+        if seq is None:
+            yield jobid,txt
+            if jobid=="FINAL":
+                return
+            continue
+        if seq<next_seq: #printed already, this is a second run of a replayed job
+            continue
+        waiting.setdefault(seq,(jobid,txt)) #a tombstone of a cancelled job stays
+        while next_seq in waiting:
+            jobid,txt=waiting.pop(next_seq)
+            next_seq+=1
+            if txt is not None:
+                yield jobid,txt
+
 def launch(args,q_in,q_out):
+    out=open_output(args.output)
     start=None
     next_report=None
     total_parsed_trees=0
     total_parsed_tokens=0
-    while True:
-        jobid,txt=q_in.get()
+    for jobid,txt in in_order(q_in):
         if jobid=="FINAL":
+            if out is sys.stdout:
+                out.flush()
+            else:
+                out.close()
             print("Output exiting",file=sys.stderr,flush=True)
+            q_out.put((jobid,txt))
             return
-        print(txt,end="",flush=True)
+        txt=to_conllu(txt)
+        out.write(txt)
+        if out is sys.stdout: #a file is written in large blocks, stdout may be read as it comes
+            out.flush()
+        q_out.put((jobid,"")) #printed, nothing left to hand back
         if start is None:
             start=time.time()
             next_report=start+10.0 #report every 10sec at most
@@ -29,7 +79,10 @@ def launch(args,q_in,q_out):
                 next_report=time.time()+10
 
     
+ordered=True #a tombstone is sent here for a job which is dropped on the way
+
 argparser = argparse.ArgumentParser(description='writer as a process')
+argparser.add_argument('--output', default="-", help='File to write, compressed if the name ends with .gz, .bz2 or .xz. Default: stdout')
 
 
 
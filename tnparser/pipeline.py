@@ -1,45 +1,1032 @@
 import asyncio
+import atexit
+import collections
 from multiprocessing import Process, Queue
 import multiprocessing as multiprocessing
+import concurrent.futures
+import threading
 import importlib
+import gc
+import traceback
+import queue
 import hashlib
+import heapq
 import random
 import time
 import os
 import yaml
-from signal import signal, SIGCHLD
+from signal import signal, SIG_DFL, SIGCHLD, SIGTERM
 import sys
 import re
 
 import logging
 
+from tnparser.conllu import Document, to_conllu
+from tnparser.metrics import Metrics, launch_metered, measure
+from tnparser.remote import launch_remote, parse_address
+
+
+replicas_regex = re.compile(r"^[×x\*]([0-9]+)$")
+
+# size of the shared array of cancelled job flags, indexed by the sequence
+# number of the job modulo this, far more than the jobs ever in flight
+CANCEL_SLOTS = 1 << 16
+
 
 def read_pipelines(fname):
+    """
+    Read pipelines.yaml, a step is either a string "module_name --params"
+    or a mapping with the string under "step" and step options such as
+    "replicas" as the other keys
+    """
     absdir = os.path.dirname(os.path.abspath(fname))
     with open(fname) as f:
         pipelines = yaml.load(f, Loader=yaml.BaseLoader)
     for pipeline_name, component_list in pipelines.items():
-        new_component_list = [c.format(thisdir=absdir) for c in component_list]
+        new_component_list = []
+        for c in component_list:
+            if isinstance(c, dict):
+                c = dict(c, step=c["step"].format(thisdir=absdir))
+            else:
+                c = c.format(thisdir=absdir)
+            new_component_list.append(c)
         pipelines[pipeline_name] = new_component_list
     return pipelines
 
 
+def step_config(step):
+    """
+    Split a pipeline step into the "module_name --params" string
+    and a dict of step options, a trailing ×N (or xN) in the string
+    is a shorthand for replicas: N
+    """
+    if isinstance(step, dict):
+        options = dict(step)
+        module_name_and_params = options.pop("step")
+    else:
+        options = {}
+        module_name_and_params = step
+    config = module_name_and_params.split()
+    match = replicas_regex.match(config[-1])
+    if len(config) > 1 and match:
+        options["replicas"] = match.group(1)
+        module_name_and_params = " ".join(config[:-1])
+    options["replicas"] = int(options.get("replicas", 1))
+    if "queue_size" in options:
+        options["queue_size"] = int(options["queue_size"])
+    if "coalesce_window" in options:
+        options["coalesce_window"] = float(options["coalesce_window"])
+    if "coalesce_tokens" in options:
+        options["coalesce_tokens"] = int(options["coalesce_tokens"])
+    if "remote" in options:
+        parse_address(options["remote"])
+    if "remote_window" in options:
+        options["remote_window"] = int(options["remote_window"])
+    if "remote_timeout" in options:
+        options["remote_timeout"] = float(options["remote_timeout"])
+    if "threads" in options:
+        options["threads"] = int(options["threads"])
+    if "cpus" in options:
+        options["cpus"] = parse_cpus(options["cpus"])
+    options["preload"] = options.get("preload", False) in (True, "true",
+                                                          "True", "yes")
+    return module_name_and_params, options
+
+
+def parse_cpus(cpus):
+    """The set of CPU numbers of a cpus option, a list or a string such as "0-3,8" """
+    if isinstance(cpus, int):
+        return {cpus}
+    if isinstance(cpus, str):
+        cpus = cpus.split(",")
+    numbers = set()
+    for part in cpus:
+        first, _, last = str(part).partition("-")
+        numbers.update(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+def cpu_quota():
+    """
+    Number of CPUs the pipeline may keep busy: the CPU quota of its cgroup
+    (v2 or v1) if there is one, the CPUs it may run on otherwise
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  #not on Linux
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, int(quota) / int(period))
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, quota / period)
+        except (OSError, ValueError):
+            pass
+    return max(1, int(cpus))
+
+
+def plan_threads(steps, budget):
+    """
+    Split budget CPUs among the processes of the steps whose modules are
+    multithreaded (torch) and have no threads option of their own, whatever
+    those take is off the budget first, return step -> threads per process
+    """
+    auto = []
+    taken = 0
+    for step in steps:
+        module_name_and_params, options = step_config(step)
+        if "remote" in options:
+            continue
+        mod = importlib.import_module("tnparser." +
+                                      module_name_and_params.split()[0])
+        if not getattr(mod, "multithreaded", False):
+            continue
+        if "threads" in options:
+            taken += options["threads"] * options["replicas"]
+        else:
+            auto.append((module_name_and_params, options["replicas"]))
+    processes = sum(replicas for _, replicas in auto)
+    if not processes:
+        return {}
+    threads = max(1, (budget - taken) // processes)
+    return {module_name_and_params: threads for module_name_and_params, _ in auto}
+
+
+def place(threads=None, cpus=None):
+    """
+    Pin this process to cpus and size the thread pools of the numeric
+    libraries to threads, before a step loads its model
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if threads:
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS",
+                    "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(threads)
+        torch = sys.modules.get("torch")  #imported with the module already
+        if torch is not None:
+            torch.set_num_threads(threads)
+
+
+def launch_placed(config, q_in, q_out):
+    """
+    Run target(args, q_in, q_out) after place()
+    config: (threads, cpus, target, args)
+    """
+    threads, cpus, target, args = config
+    place(threads, cpus)
+    target(args, q_in, q_out)
+
+
+def plan_steps(steps, fuse):
+    """Group the steps into the units started as processes, runs of fusable steps go together"""
+    units = []
+    previous_fusable = False
+    for step in steps:
+        fusable = fuse and is_fusable(step)
+        if fusable and previous_fusable:
+            units[-1].append(step)
+        else:
+            units.append([step])
+        previous_fusable = fusable
+    return units
+
+
+def load_module(step, extra_args=None):
+    """
+    Import the module of a pipeline step and parse its arguments,
+    return module_name_and_params, step options, module and args
+    """
+    module_name_and_params, options = step_config(step)
+    config = module_name_and_params.split()
+    module_name = config[0]
+    params = config[1:]
+
+    # collect extra arguments from command line meant for this particular module
+    if extra_args is not None:
+        for _name, _value in extra_args.__dict__.items():
+            if _name.startswith(module_name):
+                _modname, _argname = _name.split(
+                    ".", 1)  # for example lemmatizer_mod.gpu
+                params.append("--" + _argname)
+                params.append(str(_value))
+
+    mod = importlib.import_module("tnparser." + module_name)
+    args = mod.argparser.parse_args(params)
+    return module_name_and_params, options, mod, args
+
+
+def is_fusable(step):
+    """Whether the module of a step declares itself cheap enough to share a process"""
+    module_name_and_params, options = step_config(step)
+    if options["replicas"] != 1 or is_coalesced(options) or "remote" in options:
+        return False
+    if "threads" in options or "cpus" in options:
+        return False
+    mod = importlib.import_module("tnparser." +
+                                  module_name_and_params.split()[0])
+    return getattr(mod, "fusable", False)
+
+
+def is_coalesced(options):
+    return "coalesce_window" in options or "coalesce_tokens" in options
+
+
+class Routing:
+    """
+    Routing hints of a unit of steps: a module can attach hints to the jobs
+    it has done with routing_hints(args, txt) -> set of hint names, and name
+    with skip_hints(args) the hints on which it has nothing to do, the unit is
+    skipped when every one of its modules has nothing to do
+    """
+
+    def __init__(self, modules):
+        """modules: list of (module, args)"""
+        self.attach = [(mod.routing_hints, args) for mod, args in modules
+                       if hasattr(mod, "routing_hints")]
+        self.skip = [
+            frozenset(mod.skip_hints(args)) if hasattr(mod, "skip_hints") else
+            frozenset() for mod, args in modules
+        ]
+
+    @classmethod
+    def of(cls, modules):
+        """A Routing of the modules, None if they neither attach nor look at hints"""
+        routing = cls(modules)
+        if not routing.attach and not any(routing.skip):
+            return None
+        return routing
+
+    def hints(self, txt):
+        hints = frozenset()
+        for routing_hints, args in self.attach:
+            hints |= frozenset(routing_hints(args, txt))
+        return hints
+
+    def skips(self, hints):
+        return all(skip & hints for skip in self.skip)
+
+
+def is_cancelled(cancelled, jobid):
+    """Whether the Pipeline job "seq-hash" (or "n#seq-hash" in a replica) is flagged in cancelled"""
+    seq = jobid.split("#", 1)[-1].split("-", 1)[0]
+    return seq.isdigit() and cancelled[int(seq) % CANCEL_SLOTS] != 0
+
+
+class StepIn:
+    """
+    Input queue of a step which drops the jobs flagged in cancelled before
+    the step sees them, sends the jobs whose routing hints tell that the
+    step has nothing to do straight to out, calling on_skip() for each, and
+    keeps the hints of the others for StepOut
+    """
+
+    def __init__(self, queue, cancelled, out, routing=None, on_skip=None):
+        self.queue = queue
+        self.cancelled = cancelled
+        self.out = out
+        self.routing = routing
+        self.on_skip = on_skip
+        self.hints = {}  # jobid -> routing hints the job came with
+
+    def get(self, block=True, timeout=None):
+        while True:
+            item = self.queue.get(block, timeout)
+            jobid, txt = item[:2]
+            if jobid == "FINAL" or txt is None:
+                return item
+            if self.cancelled is not None and is_cancelled(
+                    self.cancelled, jobid):
+                if "#" in jobid:  #numbered by the feed of replicas, the merge must not wait for it
+                    self.out.put((jobid, None))
+                continue
+            hints = item[3] if len(item) > 3 else frozenset()
+            if self.routing is None or not self.routing.skips(hints):
+                if hints:  #passed on with the result, see StepOut
+                    self.hints[jobid] = hints
+                return item[:3]
+            if self.on_skip is not None:
+                self.on_skip()
+            self.out.put((jobid, txt, time.time(), hints))
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+class StepOut:
+    """
+    Output queue of a step, passes on the routing hints a job came with and
+    those the step attaches, a hint stays with the job to the end
+    """
+
+    def __init__(self, queue, step_in):
+        self.queue = queue
+        self.step_in = step_in
+
+    def put(self, item, block=True, timeout=None):
+        jobid, txt = item[:2]
+        routing = self.step_in.routing
+        hints = self.step_in.hints.pop(jobid, frozenset())
+        if routing is not None and jobid != "FINAL" and txt is not None:
+            hints = hints | routing.hints(txt)
+        if hints:
+            stamp = item[2] if len(item) > 2 else time.time()
+            item = (jobid, txt, stamp, hints)
+        self.queue.put(item, block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+
+def launch_step(target, step, proc, events, cancelled, routing, args, q_in,
+                q_out):
+    """
+    Process target running target(args, q_in, q_out) behind StepIn and
+    StepOut, with the queues metered, see launch_metered()
+    """
+    on_skip = None
+    if step:
+        on_skip = lambda: events.put(("skip", step))
+    step_in = StepIn(q_in, cancelled, q_out, routing, on_skip)
+    return launch_metered(target, step, proc, events, args, step_in,
+                          StepOut(q_out, step_in))
+
+
+def launch_coalesced(config, q_in, q_out):
+    """
+    Run a step over several jobs at once: jobs arriving within window seconds
+    of the first one, up to about max_tokens rows, are concatenated into one
+    Document for a single stage() call and the result is cut back per job
+    config: (module_name, args, window, max_tokens)
+    """
+    module_name, args, window, max_tokens = config
+    stage = importlib.import_module("tnparser." + module_name).stage(args)
+    run_coalesced(module_name, stage, window, max_tokens, q_in, q_out)
+
+
+def run_coalesced(module_name, stage, window, max_tokens, q_in, q_out):
+    """The loop of launch_coalesced() over a loaded stage"""
+    final = None
+    while final is None:
+        jobid, txt = q_in.get()
+        if jobid == "FINAL":
+            q_out.put((jobid, txt))
+            return
+        jobs = [(jobid, Document.ensure(txt))]
+        tokens = jobs[0][1].num_rows()
+        deadline = time.time() + window
+        while not max_tokens or tokens < max_tokens:
+            remaining = deadline - time.time()
+            if remaining <= 0 and not max_tokens:
+                break
+            try:
+                if remaining > 0:
+                    jobid, txt = q_in.get(timeout=remaining)
+                else:  #past the window, take what is already waiting up to the budget
+                    jobid, txt = q_in.get_nowait()
+            except queue.Empty:
+                break
+            if jobid == "FINAL":
+                final = (jobid, txt)
+                break
+            jobs.append((jobid, Document.ensure(txt)))
+            tokens += jobs[-1][1].num_rows()
+        docs = [doc for _, doc in jobs]
+        try:
+            res = Document.ensure(stage(Document.concat(docs)))
+        except:
+            print(f"{module_name} failed on jobs {[j for j, _ in jobs]}",
+                  file=sys.stderr,
+                  flush=True)
+            raise
+        for (jobid, _), part in zip(jobs, res.split([len(d) for d in docs])):
+            q_out.put((jobid, part))
+    q_out.put(final)
+
+
+def launch_fused(modules, q_in, q_out):
+    """
+    Run several light steps in one process: the stage functions are chained
+    over the same Document, which is parsed only once per job
+    modules: list of (module_name, args)
+    """
+    stages = [
+        importlib.import_module("tnparser." + module_name).stage(args)
+        for module_name, args in modules
+    ]
+    run_stages([m for m, _ in modules], stages, q_in, q_out)
+
+
+def run_stages(names, stages, q_in, q_out):
+    """The loop of launch_fused() over loaded stages"""
+    while True:
+        jobid, txt = q_in.get()
+        if jobid == "FINAL":
+            q_out.put((jobid, txt))
+            return
+        try:
+            for stage in stages:
+                txt = stage(txt)
+        except:
+            print(f"Steps {names} failed on job {jobid}",
+                  file=sys.stderr,
+                  flush=True)
+            raise
+        q_out.put((jobid, txt))
+
+
+def launch_preloaded(config, q_in, q_out):
+    """
+    Load a step once and fork its replicas from this process: they share
+    the memory pages of the loaded model for as long as they only read them
+    and start without loading anything; under a supervisor a replica which
+    dies is forked again and reported with ("died", (proc, replica),
+    exitcode) so that its jobs are replayed, without one the others are
+    stopped and this process exits with an error
+    config: (module_name, args, replicas, coalesce window, coalesce max_tokens)
+    """
+    module_name, args, replicas, window, max_tokens = config
+    stage = importlib.import_module("tnparser." + module_name).stage(args)
+    # objects allocated so far are left alone by the collector, which would
+    # otherwise write to their pages and so copy them into every replica
+    gc.collect()
+    gc.freeze()
+    proc = getattr(q_in, "proc", None)  # see MeteredIn
+
+    def fork(replica):
+        pid = os.fork()
+        if pid == 0:
+            signal(SIGTERM, SIG_DFL)
+            if proc is not None:  #the supervisor tells the replicas apart
+                q_in.proc = (proc, replica)
+            exitcode = 0
+            try:
+                if window or max_tokens:
+                    run_coalesced(module_name, stage, window, max_tokens,
+                                  q_in, q_out)
+                else:
+                    run_stages([module_name], [stage], q_in, q_out)
+                flush_queue(q_out)
+            except BaseException:
+                traceback.print_exc()
+                exitcode = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+        return pid
+
+    children = {fork(replica): replica for replica in range(replicas)}  # pid -> replica
+
+    def stop_children(signum=None, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, SIGTERM)
+            except ProcessLookupError:
+                pass
+        if signum is not None:
+            sys.exit(1)
+
+    signal(SIGTERM, stop_children)
+    failed = False
+    while children:
+        pid, status = os.wait()
+        replica = children.pop(pid)
+        if status == 0 or failed:
+            continue
+        exitcode = os.waitstatus_to_exitcode(status)
+        if proc is not None:
+            # the others go on, a replica stopped at any point could take
+            # a job with it which nobody knows about
+            print(f"{module_name}: preloaded replica {replica+1} died with exit code {exitcode}, forking it again",
+                  file=sys.stderr,
+                  flush=True)
+            q_in.events.put(("died", (proc, replica), exitcode))
+            children[fork(replica)] = replica
+            continue
+        print(f"{module_name}: a preloaded replica died, stopping the others",
+              file=sys.stderr,
+              flush=True)
+        failed = True
+        stop_children()
+    if failed:
+        sys.exit(1)
+
+
+def flush_queue(q):
+    """Wait until what was put to q is written, os._exit() would drop it"""
+    while hasattr(q, "queue"):  #metered or shared memory wrappers
+        q = q.queue
+    q.close()
+    q.join_thread()
+
+
+def plan_routes(routes):
+    """
+    The unique steps of several pipelines in an order in which every step
+    comes after the steps feeding it, steps are keyed by their
+    "module_name --params" string
+    routes: list of step lists
+    return: list of (key, step)
+    """
+    steps = {}  # key -> first step with that key
+    feeds = {}  # key -> keys of the steps right after it
+    for route in routes:
+        keys = [step_config(step)[0] for step in route]
+        if len(set(keys)) != len(keys):
+            raise ValueError(f"A pipeline goes through a step twice: {keys}")
+        for key, step in zip(keys, route):
+            steps.setdefault(key, step)
+            feeds.setdefault(key, set())
+        for key, next_key in zip(keys, keys[1:]):
+            feeds[key].add(next_key)
+    fed_by = {key: 0 for key in steps}
+    for next_keys in feeds.values():
+        for next_key in next_keys:
+            fed_by[next_key] += 1
+    ready = [key for key in steps if fed_by[key] == 0]
+    order = []
+    while ready:
+        key = ready.pop(0)
+        order.append((key, steps[key]))
+        for next_key in sorted(feeds[key]):
+            fed_by[next_key] -= 1
+            if fed_by[next_key] == 0:
+                ready.append(next_key)
+    if len(order) != len(steps):  #the queues of a cycle can fill up and wait on each other
+        raise ValueError("Pipelines go through shared steps in different orders")
+    return order
+
+
+def job_route(jobid):
+    """Route number of a job id "seq-route-hash", see Pipeline.put()"""
+    return int(jobid.split("#", 1)[-1].split("-", 2)[1])
+
+
+class RoutedQueue:
+    """
+    Output queue of a step shared by several pipelines: a job goes on to the
+    next step of its own pipeline, FINAL stops here, see Pipeline.put_final()
+    """
+
+    def __init__(self, queues):
+        self.queues = queues  # route number -> input queue of the next step
+
+    def put(self, item, block=True, timeout=None):
+        if item[0] == "FINAL":
+            return
+        self.queues[job_route(item[0])].put(item, block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+
+def raw_queue(q):
+    """The queue under a transport wrapper, for steps which only relay jobs"""
+    if isinstance(q, queue.Queue):  #thread mode, .queue is its deque
+        return q
+    return getattr(q, "queue", q)
+
+
+def unwedge(lock):
+    """
+    Release a queue lock which a killed process may have died holding,
+    only for a lock nobody else uses: a reader of a queue holds its read
+    lock even while waiting for the next job
+    """
+    if lock is not None:
+        lock.acquire(False)  #either takes the free lock or fails on the dead one
+        lock.release()
+
+
+def feed_replicas(q_in, q_replicas, replicas):
+    """Number the jobs arriving to a replicated step and hand them to the replicas"""
+    seq = 0
+    while True:
+        item = q_in.get()  # (jobid, txt, ...), the rest is passed on as it is
+        if item[0] == "FINAL":
+            for _ in range(replicas):  #every replica has to see it to exit
+                q_replicas.put(item)
+            return
+        q_replicas.put((f"{seq}#{item[0]}", ) + tuple(item[1:]))
+        seq += 1
+
+
+def merge_replicas(q_replicas, q_out, replicas):
+    """Send the jobs finished by the replicas forward in their original order"""
+    waiting = {}  # seq -> (jobid, txt, ...) finished ahead of their turn
+    next_seq = 0
+    finals = 0
+    while finals < replicas:
+        item = q_replicas.get()
+        if item[0] == "FINAL":
+            finals += 1
+            continue
+        seq, jobid = item[0].split("#", 1)
+        if int(seq) < next_seq:  #a tombstone for a job which got out after all
+            continue
+        waiting[int(seq)] = (jobid, ) + tuple(item[1:])
+        while next_seq in waiting:
+            item = waiting.pop(next_seq)
+            if item[1] is not None:  #None: lost in a replica which died, replayed from the start
+                q_out.put(item)
+            next_seq += 1
+    q_out.put(("FINAL", ""))
+
+
+comment_regex = re.compile(r"^####?\s?C:")
+
+
+class Batcher:
+    """
+    Cut a stream of input lines into job batches: a batch is full once it
+    has more than batch_lines lines, batch_chars characters or batch_tokens
+    tokens, whichever comes first (0 for no limit), and ends at the next line
+    where it may end, never inside a sentence or before the ###C: comments
+    of the next one; the state is kept line by line, nothing is rescanned
+    """
+
+    def __init__(self,
+                 batch_lines=0,
+                 batch_chars=100000,
+                 batch_tokens=0,
+                 empty_line_batching=False):
+        """empty_line_batching: cut only at empty lines, for CoNLL-U input"""
+        self.batch_lines = batch_lines
+        self.batch_chars = batch_chars
+        self.batch_tokens = batch_tokens
+        self.empty_line_batching = empty_line_batching
+        self.reset()
+
+    def reset(self):
+        self.lines = []
+        self.chars = 0
+        self.tokens = 0  # words of text, rows of CoNLL-U
+        self.has_text = False  # a line which is not empty nor a ###C: comment
+        self.ends_with_text = False  # the last line which is not empty is such
+
+    def full(self):
+        return ((self.batch_lines and len(self.lines) > self.batch_lines)
+                or (self.batch_chars and self.chars >= self.batch_chars)
+                or (self.batch_tokens and self.tokens >= self.batch_tokens))
+
+    def add(self, line):
+        """Add the next input line, return the batch it completes or None"""
+        self.lines.append(line)
+        self.chars += len(line)
+        if line.strip():
+            if comment_regex.match(line):
+                self.ends_with_text = False
+                return None
+            self.ends_with_text = self.has_text = True
+            if self.empty_line_batching:
+                self.tokens += not line.startswith("#")
+                return None
+            self.tokens += len(line.split())
+        if not self.ends_with_text or not self.full():
+            return None
+        batch = "".join(self.lines)
+        self.reset()
+        return batch
+
+    def finish(self):
+        """The last batch at the end of the input, None if it has no text"""
+        batch = "".join(self.lines) if self.has_text else None
+        if self.lines and not self.has_text:
+            print(
+                "WARNING: Comments and empty lines at the end of the input will be removed in order to produce valid conll-u. The input must not end with comments",
+                file=sys.stderr,
+                flush=True)
+        self.reset()
+        return batch
+
+
+def model_batch_tokens(steps, extra_args=None):
+    """
+    The largest prediction batch in tokens among the steps whose modules
+    tell it with batch_tokens(args), None if none does
+    """
+    sizes = []
+    for step in steps:
+        mod, args = load_module(step, extra_args)[2:]
+        if hasattr(mod, "batch_tokens"):
+            sizes.append(mod.batch_tokens(args))
+    return max(sizes) if sizes else None
+
+
+paragraph_break = re.compile(r"\n[ \t]*\n\s*")
+token_range = re.compile(r"TokenRange=(\d+):(\d+)")
+
+
+def text_chunks(txt, max_char):
+    """
+    Cut txt into pieces of at most max_char characters, in linear time: each
+    piece ends after the last paragraph break (an empty line) in the second
+    half of its window, else after the last line break, sentence end or
+    space there, else at max_char, return (start, end, starts a paragraph)
+    """
+    chunks = []
+    start = 0
+    paragraph = True
+    while len(txt) - start > max_char:
+        lo, hi = start + max_char // 2, start + max_char
+        end = None
+        for m in paragraph_break.finditer(txt, lo, hi):
+            end = m.end()
+        if end is not None:
+            next_paragraph = True
+        else:
+            next_paragraph = False
+            for sep in ("\n", ". ", " "):
+                i = txt.rfind(sep, lo, hi)
+                if i >= 0:
+                    end = i + len(sep)
+                    break
+            else:
+                end = hi
+        chunks.append((start, end, paragraph))
+        start, paragraph = end, next_paragraph
+    if start < len(txt) or not chunks:
+        chunks.append((start, len(txt), paragraph))
+    return chunks
+
+
+def stitch_chunks(parts, first=True, sent_id=0):
+    """
+    Join the CoNLL-U of the chunks of one text into one document: shift the
+    TokenRange of every token by the offset of its chunk, number the
+    sentences on from chunk to chunk and keep the newdoc only at the start
+    and the newpar only where a chunk starts a paragraph
+    parts: (conllu, offset, starts a paragraph) per chunk
+    first, sent_id: whether parts start the text, else the last sentence
+                    number of the chunks before them
+    return: (CoNLL-U, last sentence number)
+    """
+    lines = []
+    for conllu, offset, paragraph in parts:
+        if not conllu.strip():  #only whitespace in the chunk
+            continue
+
+        def shift(m):
+            return f"TokenRange={int(m.group(1)) + offset}:{int(m.group(2)) + offset}"
+
+        first_sentence = True
+        for line in conllu.split("\n"):
+            if line.startswith("#"):
+                if not first and line.startswith("# newdoc"):
+                    continue
+                if line.startswith("# newpar") and not first and first_sentence and not paragraph:
+                    continue  #cut inside a paragraph
+                if line.startswith("# sent_id"):
+                    sent_id += 1
+                    line = f"# sent_id = {sent_id}"
+            elif line:
+                first_sentence = False
+                if offset:
+                    cols = line.split("\t")
+                    if len(cols) == 10:
+                        cols[9] = token_range.sub(shift, cols[9])
+                        line = "\t".join(cols)
+            lines.append(line)
+        while lines and not lines[-1]:
+            lines.pop()
+        lines.append("")  #the empty line after the last sentence of the chunk
+        first = False
+    return "\n".join(lines) + "\n" if lines else "", sent_id
+
+
+class LargeJob:
+    """The chunk jobs of a text given to Pipeline.parse_large_txt()"""
+
+    def __init__(self, total):
+        self.chunks = collections.deque()  # (job_id, offset, starts a paragraph) put and not fetched yet, in order
+        self.total = total
+        self.forgotten = False  # stop putting the rest of the chunks
+        self.error = None  # why the rest of the chunks could not be put
+        self.fetched = 0
+        self.done = 0
+        self.tokens = 0  # in the finished chunks
+        self.sent_id = 0  # last sentence number fetched
+
+    def progress(self):
+        return {
+            "chunks": self.total,
+            "chunks_done": self.done,
+            "chunks_fetched": self.fetched,
+            "tokens_done": self.tokens
+        }
+
+
+# priorities of put(), a job waits at the entry of the pipeline while jobs
+# with a lower number are waiting
+INTERACTIVE = 0
+BULK = 10
+
+
+class StepThread(threading.Thread):
+    """
+    A step run as a thread in the thread mode, with the exitcode of a
+    Process for the supervisor: None while running, 1 if it raised
+    """
+
+    def __init__(self, target, args):
+        super().__init__(target=target, args=args, daemon=True)
+        self.exitcode = None
+
+    def run(self):
+        try:
+            super().run()
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            self.exitcode = 1
+        else:
+            self.exitcode = 0
+
+
+class JobFailed(Exception):
+    """A job was dropped after pipeline stages died on it twice"""
+
+
+class JobCancelled(JobFailed):
+    """A job was cancelled, or its deadline passed before it was done"""
+
+
 class Pipeline:
-    def __init__(self, steps, extra_args=None):
-        """ """
+    def __init__(self,
+                 steps,
+                 extra_args=None,
+                 transport="queue",
+                 mode="process",
+                 inprocess_max_chars=0,
+                 fuse=True,
+                 max_q_size=5,
+                 max_chars_in_flight=120000,
+                 max_wait=0,
+                 metrics=True,
+                 supervise=True,
+                 shortest_first=False,
+                 cpu_threads="auto"):
+        """
+        steps: the steps of the pipeline, or a dict of named pipelines which
+               share the processes of the steps they have in common (with the
+               same module and parameters), see put(pipeline=...)
+        transport: "queue" pickles job texts through the queues between steps,
+                   "shm" passes them in shared memory segments
+        mode: "process" runs every step in its own process,
+              "thread" runs every step in its own thread of this process,
+              the jobs are handed on as they are without pickling, for
+              steps which release the GIL while they work (torch, UDPipe)
+              "inprocess" runs the steps one after another in this process,
+              "hybrid" starts the processes but also loads the steps here and
+              parses texts up to inprocess_max_chars characters in this process
+        fuse: run consecutive steps whose modules are marked fusable in one process
+        max_q_size: default number of batches waiting for a step, a step can
+                    set its own with the queue_size option
+        max_chars_in_flight: parse() and parse_large_txt() refuse new texts once
+                             this many characters are in the pipeline
+        max_wait: if not 0, they also refuse when the estimated wait for the
+                  result would exceed this many seconds
+        metrics: count jobs, sentences, tokens and time per step, see metrics_text()
+        supervise: restart a step process which dies and send the jobs it held
+                   through the pipeline again, a job on which steps die twice
+                   fails with JobFailed, if False the whole program exits
+        shortest_first: among the jobs of the same priority waiting at the
+                        entry send the shortest text first instead of the
+                        oldest, a long text may then wait while short ones
+                        keep coming
+        cpu_threads: the CPUs which the multithreaded (torch) steps without
+                     a threads option of their own share, "auto" for the
+                     CPU quota of the cgroup, None to leave every step to
+                     its library defaults, which take all cores each
+        """
+        if mode not in ("process", "thread", "inprocess", "hybrid"):
+            raise ValueError(f"Unknown mode {mode}")
+        self.mode = mode
+        self.inprocess_max_chars = inprocess_max_chars
         self.ctx = multiprocessing.get_context()
-        self.job_counter = 0
-        self.done_jobs = {}
-        self.max_q_size = 5
-        self.q_in = self.ctx.Queue(
-            self.max_q_size)  #where to send data to the whole pipeline
+        self.transport = transport
+        if transport == "shm":
+            if mode == "thread":
+                raise ValueError("The threads share the memory, shm is for processes")
+            from tnparser import transport as shm_transport
+            shm_transport.prepare()
+        elif transport != "queue":
+            raise ValueError(f"Unknown transport {transport}")
+        self.jobs = {}  # job_id -> concurrent.futures.Future with the result
+        self.jobs_lock = threading.Lock()
+        self.dispatcher = None  # thread draining q_out, started on first put()
+        # jobs waiting to enter the pipeline, route number -> heap of
+        # (priority, length or 0, order, item), each fed by a thread of its own
+        self.entry = [[]]
+        self.entry_cond = threading.Condition()
+        self.entry_order = 0
+        self.entry_counts = {}  # (route, priority) -> jobs of that priority in self.entry[route]
+        self.shortest_first = shortest_first
+        self.max_q_size = max_q_size
+        self.max_chars_in_flight = max_chars_in_flight
+        self.max_wait = max_wait
+        self.job_chars = {}  # job_id -> (characters, time put) of unfinished jobs
+        self.chars_in_flight = 0
+        self.chars_per_sec = None  # measured throughput, moving average
+        self.last_done = 0.0
+        self.metrics = Metrics() if metrics else None
+        self.events = None  # reports of the step processes, see launch_step()
+        self.supervise = supervise
+        self.job_seq = 0  # sequence number of the next job sent to the processes
+        self.job_inputs = {}  # job_id -> text of unfinished jobs, to replay them
+        self.held = {}  # job_id -> (process index or (index, preloaded replica), id on the wire, put out) of the last process which took it
+        self.crashes = {}  # job_id -> number of processes which died working on it alone
+        self.suspects = collections.deque()  # jobs a process died working on together, see add_suspects()
+        self.replaying = None  # the suspect replayed alone right now
+        self.restarts = {}  # process index -> deaths since it last handed a job on
+        self.tombstones = {}  # process index of a replica -> queue of its merge
+        self.preloaded = set()  # process index of preloaded replicas, which die together
+        self.sinks = {}  # process index of an ordered step -> its input queue, told of dropped jobs
+        self.broken = False  # gave up restarting
+        self.closing = False  # the program is exiting, the processes are stopped on purpose
+        self.supervise_lock = threading.Lock()  # held while checking and restarting processes
+        self.pending = []  # (queue, item) the watcher could not put yet
+        self.pending_lock = threading.Lock()
+        self.deadlines = {}  # job_id -> time.time() after which the job is cancelled
+        # flags of cancelled jobs shared with the step processes, which skip them
+        self.cancelled = self.ctx.RawArray(
+            "b", CANCEL_SLOTS) if mode != "inprocess" else None
+        self.routes = None  # name -> route number, if several pipelines
+        if isinstance(steps, dict):
+            if mode not in ("process", "thread"):
+                raise ValueError(
+                    "Several pipelines run in the process or thread mode only")
+            self.routes = {name: i for i, name in enumerate(steps)}
+            self.entry = [[] for _ in steps]
+            steps = [[
+                step for step in route if not (isinstance(step, str)
+                                               and step.startswith("extraoptions"))
+            ] for route in steps.values()]
+            units = []
+        else:
+            if mode in ("inprocess", "hybrid") and any(
+                    "remote" in step_config(step)[1] for step in steps):
+                raise ValueError(
+                    "Remote steps run in the process or thread mode only")
+            units = plan_steps(steps, fuse) if mode != "inprocess" else []
+        # threads per process of the steps, settings of a whole process which
+        # the thread mode cannot have per step
+        self.threads = {}
+        if mode in ("process", "hybrid") and cpu_threads is not None:
+            unique_steps = {
+                step_config(step)[0]: step
+                for route in (steps if self.routes is not None else [steps])
+                for step in route
+            }
+            self.threads = plan_threads(
+                unique_steps.values(),
+                cpu_quota() if cpu_threads == "auto" else cpu_threads)
+        self.q_in = self.new_queue(
+            self.unit_queue_size(units[0]) if units else self.
+            max_q_size)  #where to send data to the whole pipeline
         self.q_out = self.q_in  #where to receive data from the whole pipeline
         self.modules = []
         self.processes = []
-        self.large_jobs = []
+        self.targets = []  # (target, args) of the processes, to restart them
+        self.large_jobs = {}  # large job id -> LargeJob
+        self.stages = []  # steps loaded into this process
+        self.inprocess_lock = threading.Lock()
 
-        for mod_name_and_params in steps:
-            self.add_step(mod_name_and_params, extra_args)
+        for i, unit in enumerate(units):
+            # the output queue of a unit is the input queue of the next one
+            queue_size = self.unit_queue_size(
+                units[i + 1]) if i + 1 < len(units) else self.max_q_size
+            if len(unit) > 1:
+                self.add_fused_step(unit, extra_args, queue_size)
+            else:
+                self.add_step(unit[0], extra_args, queue_size)
+        if self.routes is not None:
+            self.add_routes(steps, extra_args)
+        if mode in ("inprocess", "hybrid"):
+            # loaded only after the steps have forked, the children must not
+            # inherit an initialized CUDA context
+            for mod_name_and_params in steps:
+                self.add_inprocess_step(mod_name_and_params, extra_args)
+        if not self.processes:
+            return
+        # runs before multiprocessing terminates the daemonic processes at exit
+        atexit.register(self.stop_supervising)
+        threading.Thread(target=self.watch, daemon=True).start()
+        for route in range(len(self.entry)):
+            threading.Thread(target=self.feed_entry,
+                             args=(route, ),
+                             daemon=True).start()
+        if self.supervise or mode == "thread":
+            return
         try:
             signal(SIGCHLD, self.handle_sigchld)
         except ValueError:
@@ -48,10 +1035,13 @@ class Pipeline:
 
     def handle_sigchld(self, signum, frame):
         while 1:
-            pid, exitno = os.waitpid(0, os.WNOHANG)
+            try:
+                pid, exitno = os.waitpid(0, os.WNOHANG)
+            except ChildProcessError:  #already reaped, e.g. by multiprocessing at exit
+                return
             if pid == 0:
                 return
-            if exitno == 0:
+            if exitno == 0 or self.closing:
                 continue
             for module, process in zip(self.modules, self.processes):
                 if process.pid != pid:
@@ -67,193 +1057,1079 @@ class Pipeline:
             p.join()
 
     def is_alive(self):
+        if self.supervise:
+            return not self.broken
         for p in self.processes:
             if not p.is_alive():
                 return False
         return True
 
-    def add_step(self, module_name_and_params, extra_args):
-        config = module_name_and_params.split()
-        module_name = config[0]
-        params = config[1:]
-
-        # collect extra arguments from command line meant for this particular module
-        if extra_args is not None:
-            for _name, _value in extra_args.__dict__.items():
-                if _name.startswith(module_name):
-                    _modname, _argname = _name.split(
-                        ".", 1)  # for example lemmatizer_mod.gpu
-                    params.append("--" + _argname)
-                    params.append(str(_value))
-
-        mod = importlib.import_module("tnparser." + module_name)
+    def unit_queue_size(self, unit):
+        """Size of the input queue of a unit of steps"""
+        return step_config(unit[0])[1].get("queue_size", self.max_q_size)
+
+    def add_routes(self, routes, extra_args):
+        """
+        Start every step of several pipelines once, each with an input
+        queue of its own and a RoutedQueue to the steps after it
+        """
+        order = plan_routes(routes)
+        self.route_inputs = {
+            key: self.new_queue(self.unit_queue_size([step]))
+            for key, step in order
+        }  # step key -> its input queue
+        self.q_out = self.new_queue(self.max_q_size)  #the ends of all pipelines
+        next_queues = {key: {} for key, _ in order}
+        self.route_starts = []  # route number -> input queue of its first step
+        for i, route in enumerate(routes):
+            keys = [step_config(step)[0] for step in route]
+            self.route_starts.append(self.route_inputs[keys[0]])
+            for key, next_key in zip(keys, keys[1:] + [None]):
+                next_queues[key][i] = self.route_inputs[
+                    next_key] if next_key is not None else self.q_out
+        q_end = self.q_out
+        for key, step in order:
+            if getattr(load_module(step, extra_args)[2], "ordered", False):
+                raise ValueError(f"Pipelines cannot share an ordered step: {key}")
+            self.q_out = self.route_inputs[key]
+            self.add_step(step, extra_args,
+                          step_out=RoutedQueue(next_queues[key]))
+        self.q_out = q_end
+
+    def entry_queue(self, job_id):
+        """The queue where the job enters the pipeline"""
+        if self.routes is None:
+            return self.q_in
+        return self.route_starts[job_route(job_id)]
+
+    def add_step(self, step, extra_args, queue_size=None, step_out=None):
+        module_name_and_params, options, mod, args = load_module(
+            step, extra_args)
+        step_in = self.q_out
+        self.q_out = step_out or self.new_queue(
+            queue_size or self.max_q_size)  #new pipeline end
+        replicas = options["replicas"]
+        target, target_args = mod.launch, args
+        if is_coalesced(options):
+            if not getattr(mod, "coalescable", False):
+                raise ValueError(
+                    f"Step cannot coalesce jobs: {module_name_and_params}")
+            target = launch_coalesced
+            target_args = (module_name_and_params.split()[0], args,
+                           options.get("coalesce_window", 0.0),
+                           options.get("coalesce_tokens", 0))
+        if options["preload"]:
+            if self.mode == "thread":
+                raise ValueError(
+                    f"The thread mode has nothing to preload: {module_name_and_params}"
+                )
+            if replicas == 1 or getattr(mod, "ordered", False):
+                raise ValueError(
+                    f"Only a replicated step can be preloaded: {module_name_and_params}"
+                )
+            target = launch_preloaded
+            target_args = (module_name_and_params.split()[0], args, replicas,
+                           options.get("coalesce_window", 0.0),
+                           options.get("coalesce_tokens", 0))
+        if "remote" in options:
+            if replicas != 1 or options["preload"] or is_coalesced(options):
+                raise ValueError(
+                    f"A remote step runs one copy on its worker, it cannot have replicas or be coalesced: {module_name_and_params}"
+                )
+            target = launch_remote
+            target_args = (options["remote"], module_name_and_params.split()[0],
+                           options.get("remote_window", self.max_q_size),
+                           options.get("remote_timeout", 60.0))
+        if getattr(mod, "ordered", False) and replicas == 1:
+            self.sinks[len(self.processes)] = step_in
+        routing = Routing.of([(mod, args)])
+        threads = options.get("threads",
+                              self.threads.get(module_name_and_params))
+        if (threads or options.get("cpus")
+            ) and self.mode != "thread" and "remote" not in options:
+            target, target_args = launch_placed, (threads, options.get("cpus"),
+                                                  target, target_args)
+        if replicas == 1:
+            self.start_step(module_name_and_params, module_name_and_params,
+                            target, target_args, step_in, self.q_out, routing)
+            return
+        # N copies of the module read the same queue, jobs are numbered on the
+        # way in so that the merge can restore their order on the way out
+        q_replicas_in = self.new_queue(self.max_q_size)
+        q_replicas_out = self.new_queue(self.max_q_size * replicas)
+        # feed and merge only relay jobs, shared memory handles pass as they are
+        self.start_process(f"{module_name_and_params} (feed)", feed_replicas,
+                           (raw_queue(step_in), raw_queue(q_replicas_in),
+                            replicas))
+        first = len(self.processes)
+        if options["preload"]:  #one process which forks the replicas
+            self.preloaded.add(len(self.processes))
+            self.start_step(f"{module_name_and_params} (preloaded ×{replicas})",
+                            module_name_and_params, target, target_args,
+                            q_replicas_in, q_replicas_out, routing)
+        else:
+            for i in range(replicas):
+                self.start_step(
+                    f"{module_name_and_params} (replica {i+1}/{replicas})",
+                    module_name_and_params, target, target_args,
+                    q_replicas_in, q_replicas_out, routing)
+        if self.metrics is not None:  #the replicas report as one step
+            self.metrics.add_step(module_name_and_params, step_in)
+        for proc in range(first, len(self.processes)):
+            self.tombstones[proc] = raw_queue(q_replicas_out)
+        self.start_process(f"{module_name_and_params} (merge)",
+                           merge_replicas,
+                           (raw_queue(q_replicas_out), raw_queue(self.q_out),
+                            replicas))
+
+    def add_fused_step(self, steps, extra_args, queue_size=None):
+        names = []
+        modules = []
+        loaded = []
+        for step in steps:
+            module_name_and_params, options, mod, args = load_module(
+                step, extra_args)
+            names.append(module_name_and_params)
+            modules.append((module_name_and_params.split()[0], args))
+            loaded.append((mod, args))
         step_in = self.q_out
-        self.q_out = self.ctx.Queue(self.max_q_size)  #new pipeline end
-        args = mod.argparser.parse_args(params)
-        process = self.ctx.Process(target=mod.launch,
-                                   args=(args, step_in, self.q_out))
+        self.q_out = self.new_queue(queue_size or
+                                    self.max_q_size)  #new pipeline end
+        # metered as one step "a + b", the stages are not timed apart
+        self.start_step(" + ".join(names), " + ".join(names), launch_fused,
+                        modules, step_in, self.q_out, Routing.of(loaded))
+
+    def add_inprocess_step(self, step, extra_args):
+        module_name_and_params, options, mod, args = load_module(
+            step, extra_args)
+        self.stages.append((module_name_and_params, mod.stage(args),
+                            Routing.of([(mod, args)])))
+
+    def run_inprocess(self, txt):
+        """Run txt through the steps loaded in this process and return the result"""
+        hints = frozenset()
+        with self.inprocess_lock:  #the steps are not thread-safe
+            for name, stage, routing in self.stages:
+                if routing is not None and routing.skips(hints):
+                    if self.metrics is not None:
+                        self.metrics.record_skip(name)
+                    continue
+                if self.metrics is None:
+                    txt = stage(txt)
+                else:
+                    started = time.time()
+                    chars_in = measure(txt)[0]
+                    txt = stage(txt)
+                    chars_out, sentences, tokens = measure(txt)
+                    self.metrics.record(name, time.time() - started, None,
+                                        chars_in, chars_out, sentences, tokens)
+                if routing is not None:
+                    hints |= routing.hints(txt)
+        return to_conllu(txt)
+
+    def route_inprocess(self, txt):
+        """
+        Whether to parse txt in this process: always in the inprocess mode,
+        in the hybrid mode if it is short and no other text is being parsed here
+        """
+        if self.mode == "inprocess":
+            return True
+        if self.mode in ("process", "thread") or len(txt) > self.inprocess_max_chars:
+            return False
+        return not self.inprocess_lock.locked()
+
+    def new_queue(self, maxsize):
+        if self.mode == "thread":
+            return queue.Queue(maxsize)
+        q = self.ctx.Queue(maxsize)
+        if self.transport == "shm":
+            from tnparser.transport import SharedMemoryQueue
+            q = SharedMemoryQueue(q)
+        return q
+
+    def start_step(self, module, step, target, args, q_in, q_out, routing=None):
+        """
+        Start the process running target(args, q_in, q_out), with metered
+        queues reporting under the name step if metrics are on and the jobs
+        the process holds if supervising, skipping cancelled jobs and those
+        which routing tells have nothing to do here
+        """
+        if self.events is None and (self.metrics is not None
+                                    or self.supervise):
+            # written straight to the pipe, a report is not lost if the
+            # process dies right after it like with the feeder thread of a Queue
+            self.events = queue.SimpleQueue(
+            ) if self.mode == "thread" else self.ctx.SimpleQueue()
+        if self.metrics is not None:
+            self.metrics.add_step(step, q_in)
+        else:
+            step = None
+        proc = len(self.processes) if self.supervise else None
+        self.start_process(
+            module, launch_step,
+            (target, step, proc, self.events, self.cancelled, routing, args,
+             q_in, q_out))
+
+    def new_process(self, target, args):
+        """A process running target(*args), a StepThread in the thread mode"""
+        if self.mode == "thread":
+            return StepThread(target, args)
+        process = self.ctx.Process(target=target, args=args)
         process.daemon = True
+        return process
+
+    def start_process(self, module, target, args):
+        process = self.new_process(target, args)
         process.start()
-        self.modules.append(module_name_and_params)
+        self.modules.append(module)
         self.processes.append(process)
+        self.targets.append((target, args))
+
+    def watch(self):
+        """
+        Thread reading the reports of the step processes and cancelling the
+        jobs past their deadline, if supervising also restarts the processes
+        which die
+        """
+        next_check = 0.0
+        while True:
+            if self.events is None or self.events.empty():
+                time.sleep(0.05)
+            while self.events is not None and not self.events.empty():
+                self.handle_event(self.events.get())
+            self.put_pending()
+            self.expire_jobs()
+            if self.supervise and not self.broken and not self.closing and time.time() >= next_check:
+                self.check_processes()
+                next_check = time.time() + 0.2
+
+    def stop_supervising(self):
+        """
+        Called at exit: the processes which multiprocessing then terminates
+        are not to be restarted, nor is a dying one a crash any more
+        """
+        with self.supervise_lock:
+            self.closing = True
+
+    def put_pending(self, q=None, item=None):
+        """
+        Put item to q without blocking, what does not fit is kept and tried
+        again later: the watcher must go on watching while the queues are full
+        """
+        with self.pending_lock:
+            if q is not None:
+                self.pending.append((q, item))
+            still_pending = []
+            for q, item in self.pending:
+                try:
+                    q.put_nowait(item)
+                except queue.Full:
+                    still_pending.append((q, item))
+            self.pending = still_pending
+
+    def handle_event(self, event):
+        """
+        ("take" or "out", proc, jobid), ("done", step, stats) or ("skip", step),
+        see launch_step(), or ("died", replica, exitcode), see launch_preloaded()
+        """
+        if event[0] == "done":
+            self.metrics.record(event[1], *event[2])
+            return
+        if event[0] == "skip":
+            self.metrics.record_skip(event[1])
+            return
+        if event[0] == "died":
+            if not self.broken and not self.closing:
+                self.replica_died(*event[1:])
+            return
+        # a job is in the care of the last process which took it until the
+        # next one takes it: what a process has put out may still be in its
+        # buffers and die with it, but it was not what killed the process
+        kind, proc, wire_id = event
+        job_id = wire_id.split("#", 1)[-1]
+        with self.jobs_lock:
+            if job_id not in self.job_inputs:
+                return
+            previous = self.held.get(job_id)
+            if kind == "out":
+                if previous is not None and previous[0] == proc:
+                    self.held[job_id] = (proc, wire_id, True)
+                return
+            if previous is not None and previous[0] != proc:
+                self.restarts[previous[0]] = 0
+            self.held[job_id] = (proc, wire_id, False)
+
+    def check_processes(self):
+        with self.supervise_lock:
+            for proc, process in enumerate(self.processes):
+                if self.closing:
+                    return
+                if not process.exitcode:  #running or finished normally
+                    continue
+                while not self.events.empty():  #what the process reported before it died
+                    self.handle_event(self.events.get())
+                self.restart(proc)
+                if self.broken:
+                    return
+
+    def restart(self, proc):
+        """Start a dead process again, replay the jobs it held"""
+        module = self.modules[proc]
+        exitcode = self.processes[proc].exitcode
+        if self.targets[proc][0] is not launch_step:  #feed and merge know no jobs
+            self.give_up(f"pipeline process died with exit code {exitcode}: {module}")
+            return
+        if proc in self.sinks:  #could not know where to go on in the output
+            self.give_up(f"pipeline process died with exit code {exitcode}: {module}")
+            return
+        lost = self.take_lost(proc)
+        self.restarts[proc] = self.restarts.get(proc, 0) + 1
+        if self.restarts[proc] > 3:  #not a bad job, the step itself is broken
+            self.give_up(f"pipeline stage keeps dying, exit code {exitcode}: {module}")
+            return
+        print(
+            f"Error: pipeline stage died with exit code {exitcode} holding {len(lost)} jobs, restarting it: {module}",
+            file=sys.stderr,
+            flush=True)
+        # NOTE: in the hybrid mode this forks a process with the models
+        # loaded, a step which cannot use a forked CUDA context keeps dying
+        target, args = self.targets[proc]
+        # the only reader of q_in and writer of q_out, preloaded replicas
+        # stopped by their parent may have been waiting for a job; this
+        # process writes the tombstones to the input of an ordered step, a
+        # lock of it which looks held may be held here
+        if proc not in self.tombstones or proc in self.preloaded:
+            q_in, q_out = args[-2:]
+            unwedge(getattr(raw_queue(q_in), "_rlock", None))
+            if all(raw_queue(q_out) is not raw_queue(q)
+                   for q in self.sinks.values()):
+                unwedge(getattr(raw_queue(q_out), "_wlock", None))
+        process = self.new_process(target, args)
+        try:
+            process.start()
+        except Exception as e:
+            self.give_up(f"could not restart {module}: {e}")
+            return
+        self.processes[proc] = process
+        self.replay_lost(proc, lost, module)
+
+    def replica_died(self, replica, exitcode):
+        """A preloaded replica (process index, replica number) died and was forked again"""
+        proc = replica[0]
+        module = self.modules[proc]
+        lost = self.take_lost(replica)
+        self.restarts[replica] = self.restarts.get(replica, 0) + 1
+        if self.restarts[replica] > 3:
+            self.give_up(f"pipeline stage keeps dying, exit code {exitcode}: {module}")
+            return
+        print(
+            f"Error: preloaded replica {replica[1]+1} died with exit code {exitcode} holding {len(lost)} jobs: {module}",
+            file=sys.stderr,
+            flush=True)
+        self.replay_lost(proc, lost, module)
+
+    def take_lost(self, holder):
+        """
+        Forget and return (job_id, id on the wire, put out) of the jobs held
+        by holder, a process index or a preloaded replica of it
+        """
+        with self.jobs_lock:
+            lost = [(job_id, wire_id, out)
+                    for job_id, (p, wire_id, out) in self.held.items()
+                    if p == holder or (isinstance(p, tuple) and p[0] == holder)]
+            for job_id, _, _ in lost:
+                del self.held[job_id]
+        return lost
+
+    def replay_lost(self, proc, lost, module):
+        """Send the jobs lost in a dead process through the pipeline again"""
+        # only a job taken and not put out yet can have killed the process
+        working = [job_id for job_id, _, out in lost if not out]
+        for job_id, wire_id, out in lost:
+            if proc in self.tombstones:  #the merge must not wait for it
+                self.put_pending(self.tombstones[proc], (wire_id, None))
+            if len(working) > 1 and not out:
+                continue  #replayed one at a time below
+            if not out:
+                self.crashes[job_id] = self.crashes.get(job_id, 0) + 1
+                if self.crashes[job_id] >= 2:
+                    self.quarantine(job_id, module)
+                    continue
+            with self.jobs_lock:
+                txt = self.job_inputs.get(job_id)
+            if txt is not None:
+                self.put_pending(self.entry_queue(job_id),
+                                 self.job_item(job_id, txt))
+        if len(working) > 1:
+            self.add_suspects(working)
+
+    def add_suspects(self, job_ids):
+        """
+        Jobs a process died working on together, in a coalesced batch or in
+        preloaded replicas, any one of them may have killed it: they are
+        replayed one at a time, so that a job which kills a process again
+        does it alone and is counted as the culprit
+        """
+        with self.jobs_lock:
+            if self.replaying in job_ids:
+                self.replaying = None
+            for job_id in job_ids:
+                if job_id not in self.suspects:
+                    self.suspects.append(job_id)
+        self.replay_suspect()
+
+    def replay_suspect(self):
+        """Replay the next suspect, unless the one before it is not done yet"""
+        item = None
+        with self.jobs_lock:
+            while self.replaying is None and self.suspects:
+                job_id = self.suspects.popleft()
+                txt = self.job_inputs.get(job_id)
+                if txt is not None:  #not failed or cancelled meanwhile
+                    self.replaying = job_id
+                    item = self.job_item(job_id, txt)
+        if item is not None:
+            self.put_pending(self.entry_queue(item[0]), item)
+
+    def quarantine(self, job_id, module):
+        """Drop a job on which stages died twice, its future fails with JobFailed"""
+        print(f"Error: dropped job {job_id}, pipeline stages died on it twice, last {module}",
+              file=sys.stderr,
+              flush=True)
+        for q in self.sinks.values():
+            self.put_pending(q, (job_id, None))
+        self.fail_job(job_id, JobFailed(f"Pipeline stages died on the job twice, last {module}"))
+
+    def fail_job(self, job_id, error):
+        with self.jobs_lock:
+            future = self.jobs.get(job_id)
+            if future is None:
+                future = concurrent.futures.Future()
+                self.jobs[job_id] = future
+        if future.done():
+            return
+        self.release_job(job_id)
+        future.set_exception(error)
+
+    def give_up(self, message):
+        """A process died which cannot be restarted, fail every unfinished job"""
+        print(f"Error: {message}", file=sys.stderr, flush=True)
+        self.broken = True
+        with self.jobs_lock:
+            unfinished = list(self.job_inputs)
+        for job_id in unfinished:
+            self.fail_job(job_id, JobFailed(message))
 
     def send_final(self):
-        self.q_in.put(("FINAL", ""))
+        if not self.processes:
+            return
+        while self.supervise and not self.broken:  #a job may still be replayed
+            with self.jobs_lock:
+                if not self.job_inputs:
+                    break
+            time.sleep(0.1)
+        self.enter(("FINAL", ""), float("inf"))
+
+    def enter(self, item, priority, size=0):
+        """
+        Queue item for its pipeline behind the items of lower priority numbers,
+        block while max_q_size items of the same priority are waiting for it,
+        FINAL goes to every pipeline
+        """
+        if item[0] == "FINAL":
+            routes = range(len(self.entry))
+        else:
+            routes = [0 if self.routes is None else job_route(item[0])]
+        with self.entry_cond:
+            for route in routes:
+                key = (route, priority)
+                while self.entry_counts.get(key, 0) >= self.max_q_size:
+                    self.entry_cond.wait()
+                heapq.heappush(self.entry[route],
+                               (priority, size if self.shortest_first else 0,
+                                self.entry_order, item))
+                self.entry_order += 1
+                self.entry_counts[key] = self.entry_counts.get(key, 0) + 1
+            self.entry_cond.notify_all()
+
+    def feed_entry(self, route):
+        """
+        Thread moving the most urgent waiting job of a pipeline to its first
+        step whenever that has room, one per pipeline so that a busy one
+        does not hold up the jobs of the others
+        """
+        entry = self.entry[route]
+        while True:
+            with self.entry_cond:
+                while not entry:
+                    self.entry_cond.wait()
+                priority, _, _, item = heapq.heappop(entry)
+                self.entry_counts[(route, priority)] -= 1
+                self.entry_cond.notify_all()
+            if item[0] == "FINAL":
+                if route == 0:  #it tells every pipeline once all are done
+                    self.put_final()
+                return
+            with self.jobs_lock:
+                if item[0] not in self.job_chars:  #cancelled while waiting
+                    continue
+            self.entry_queue(item[0]).put(item)
+
+    def put_final(self):
+        """
+        Tell the steps to exit, several pipelines can only tell each step
+        when no job is left anywhere, the dispatcher last
+        """
+        if self.routes is None:
+            self.q_in.put(("FINAL", ""))
+            return
+        while True:
+            with self.jobs_lock:
+                if not self.job_chars:
+                    break
+            time.sleep(0.1)
+        for q in self.route_inputs.values():
+            q.put(("FINAL", ""))
+        self.q_out.put(("FINAL", ""))
+
+    def start_dispatcher(self):
+        """Start the thread which reads q_out and completes the job futures"""
+        with self.jobs_lock:
+            if self.dispatcher is not None:
+                return
+            self.dispatcher = threading.Thread(target=self.dispatch,
+                                               daemon=True)
+        self.dispatcher.start()
+
+    def dispatch(self):
+        """Sole reader of q_out: hand every finished job to its future"""
+        while True:
+            finished_id, finished = self.q_out.get()[:2]
+            if finished_id == "FINAL":
+                return
+            with self.jobs_lock:
+                future = self.jobs.get(finished_id)
+                running = finished_id in self.job_chars
+            # not running: cancelled or failed, or a second run of a replayed
+            # job already handed out; None: the tombstone of such a job
+            if not running or finished is None:
+                continue
+            self.job_finished(finished_id)
+            if future is not None and not future.done():  #None: nobody waits for it any more
+                future.set_result(to_conllu(finished))
+
+    def release_job(self, batch_id):
+        """
+        Forget the bookkeeping of a job which left the pipeline,
+        return its (characters, time put)
+        """
+        with self.jobs_lock:
+            self.job_inputs.pop(batch_id, None)
+            self.deadlines.pop(batch_id, None)
+            proc = self.held.pop(batch_id, (None, ))[0]
+            if proc is not None:
+                self.restarts[proc] = 0
+            self.crashes.pop(batch_id, None)
+            chars, started = self.job_chars.pop(batch_id, (0, time.time()))
+            self.chars_in_flight -= chars
+            next_suspect = batch_id == self.replaying
+            if next_suspect:
+                self.replaying = None
+        if next_suspect:
+            self.replay_suspect()
+        return chars, started
+
+    def job_finished(self, batch_id):
+        """Release the characters of a finished job and update the throughput estimate"""
+        now = time.time()
+        chars, started = self.release_job(batch_id)
+        with self.jobs_lock:
+            # the pipeline has been busy with this job since it came in or
+            # since the previous job came out, whichever was later
+            busy = now - max(started, self.last_done)
+            self.last_done = now
+            if chars and busy > 0:
+                if self.chars_per_sec is None:
+                    self.chars_per_sec = chars / busy
+                else:
+                    self.chars_per_sec = 0.8 * self.chars_per_sec + 0.2 * chars / busy
+
+    def estimated_wait(self, chars=0):
+        """
+        Seconds until a new text of chars characters would be parsed, given
+        what is in flight and the throughput so far, None if not measured yet
+        """
+        with self.jobs_lock:
+            if not self.chars_per_sec:
+                return None
+            return (self.chars_in_flight + chars) / self.chars_per_sec
 
-    def put(self, txt, final=False):
-        """Start parsing a job, return id which can be used to retrieve the result"""
+    def admit(self, chars):
+        """Whether a text of chars characters fits the admission limits right now"""
+        with self.jobs_lock:
+            in_flight = self.chars_in_flight
+        if in_flight == 0:  #an idle pipeline takes anything
+            return True
+        if in_flight + chars > self.max_chars_in_flight:
+            return False
+        if self.max_wait:
+            wait = self.estimated_wait(chars)
+            if wait is not None and wait > self.max_wait:
+                return False
+        return True
+
+    def metrics_text(self):
+        """Per step metrics and the admission state in the Prometheus text format"""
+        with self.jobs_lock:
+            chars_in_flight = self.chars_in_flight
+        lines = [
+            "# HELP tnpp_chars_in_flight Characters of the unfinished jobs",
+            "# TYPE tnpp_chars_in_flight gauge",
+            f"tnpp_chars_in_flight {chars_in_flight}"
+        ]
+        res = "\n".join(lines) + "\n"
+        if self.metrics is not None:
+            res += self.metrics.render()
+        return res
+
+    def put(self,
+            txt,
+            final=False,
+            deadline=None,
+            priority=INTERACTIVE,
+            pipeline=None,
+            fetch=True):
+        """
+        Start parsing a job, return id which can be used to retrieve the result
+        deadline: time.time() after which the job is cancelled if not done
+        priority: jobs with a lower number overtake this one at the entry,
+                  e.g. INTERACTIVE requests overtake BULK texts; once inside
+                  the steps the jobs go first come first served
+        pipeline: the name of the pipeline to run the job through if there
+                  are several, the first one by default
+        fetch: False for a job whose result nobody gets, e.g. one which
+               output_mod writes out, it is forgotten as soon as it is done
+        """
+        if self.routes is not None:
+            if pipeline is None:
+                pipeline = next(iter(self.routes))
+            if pipeline not in self.routes:
+                raise KeyError(f"Unknown pipeline {pipeline}")
         batch_id = hashlib.md5(
             (str(random.random()) + txt).encode("utf-8")).hexdigest()
-        self.q_in.put((batch_id, txt))  #first job of 1 total
-        self.job_counter += 1
+        with self.jobs_lock:
+            if self.mode != "inprocess":
+                # numbered so that ordered steps such as output_mod can
+                # keep the order even if a job is replayed after a crash
+                if self.routes is not None:
+                    batch_id = f"{self.routes[pipeline]}-{batch_id}"
+                batch_id = f"{self.job_seq}-{batch_id}"
+                self.cancelled[self.job_seq % CANCEL_SLOTS] = 0
+                self.job_seq += 1
+                self.job_chars[batch_id] = (len(txt), time.time())
+                self.chars_in_flight += len(txt)
+                if self.supervise:
+                    self.job_inputs[batch_id] = txt
+                if deadline is not None:
+                    self.deadlines[batch_id] = deadline
+            self.jobs[batch_id] = concurrent.futures.Future()
+        if not fetch:
+            self.jobs[batch_id].add_done_callback(
+                lambda f: self.pop_job(batch_id))
+        if self.mode == "inprocess":  #no processes, the job is done right away
+            self.jobs[batch_id].set_result(self.run_inprocess(txt))
+            return batch_id
+        self.start_dispatcher()
+        self.enter(self.job_item(batch_id, txt), priority, len(txt))
         if final:
-            self.q_in.put(("FINAL", ""))
+            self.enter(("FINAL", ""), float("inf"))
         return batch_id
 
-    def get(self, batch_id):
+    def cancel(self, batch_id, reason="Job cancelled"):
+        """
+        Drop an unfinished job: the steps skip it from now on and its future
+        fails with JobCancelled, the job is forgotten right away,
+        return False if it is unknown or done already
+        """
+        with self.jobs_lock:
+            future = self.jobs.get(batch_id)
+            if (future is None or future.done()
+                    or batch_id not in self.job_chars):
+                return False
+        self.cancelled[int(batch_id.split("-", 1)[0]) % CANCEL_SLOTS] = 1
+        for q in self.sinks.values():  #do not wait for it to keep the order
+            self.put_pending(q, (batch_id, None))
+        self.fail_job(batch_id, JobCancelled(reason))
+        self.pop_job(batch_id)
+        return True
+
+    def expire_jobs(self):
+        """Cancel the jobs past their deadline"""
+        now = time.time()
+        with self.jobs_lock:
+            expired = [
+                job_id for job_id, deadline in self.deadlines.items()
+                if deadline <= now
+            ]
+        for job_id in expired:
+            if not self.cancel(job_id, "Job deadline passed"):
+                with self.jobs_lock:
+                    self.deadlines.pop(job_id, None)
+
+    def job_item(self, batch_id, txt):
+        """What goes to q_in for a job"""
+        if self.metrics is not None:  #stamped for the queue wait of the first step
+            return (batch_id, txt, time.time())
+        return (batch_id, txt)
+
+    def get(self, batch_id, timeout=None):
+        """
+        Wait for the result of batch_id and return it,
+        if batch_id is None, return whichever job finishes first,
+        return None if the timeout expires before the job is done,
+        raise JobFailed if the job was dropped, JobCancelled if cancelled
+        """
         if batch_id is None:  #get any next batch, don't care about batch_id
-            _, finished = self.q_out.get()
-            self.job_counter -= 1
-            return finished
-        elif batch_id in self.done_jobs:
-            self.job_counter -= 1
-            return self.done_jobs.pop(batch_id)
-        else:
-            #get the next job, maybe it's the one?
-            finished_id, finished = self.q_out.get()
-            if finished_id == batch_id:
-                self.job_counter -= 1
-                return finished
-            else:  #something got done, but it's not the right one
-                self.done_jobs[finished_id] = finished
-                return None  #whoever asked will have to ask again
-
-    def empty_q_out(self):
+            with self.jobs_lock:
+                futures = list(self.jobs.values())
+            done, _ = concurrent.futures.wait(
+                futures,
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                return None
+            with self.jobs_lock:
+                batch_id = next(job_id for job_id, f in self.jobs.items()
+                                if f in done)
+        future = self.job_future(batch_id)
         try:
-            while True:
-                # get all the nowait jobs and set as finished
-                finished_id, finished = self.q_out.get_nowait()
-                self.done_jobs[finished_id] = finished
-        except:
-            pass
+            finished = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        finally:
+            if future.done():
+                self.pop_job(batch_id)
+        return finished
 
-    def parse(self, txt):
+    def job_future(self, batch_id):
+        with self.jobs_lock:
+            future = self.jobs.get(batch_id)
+        if future is None:
+            raise KeyError(f"Unknown job id {batch_id}")
+        return future
+
+    def pop_job(self, batch_id):
+        """Forget a job whose result has been handed to the caller"""
+        with self.jobs_lock:
+            self.jobs.pop(batch_id, None)
+
+    def is_done(self, batch_id):
+        with self.jobs_lock:
+            future = self.jobs.get(batch_id)
+        return future is not None and future.done()
+
+    def parse(self, txt, timeout=None, priority=INTERACTIVE, pipeline=None):
         """
         return res if queue is not full, else return False
+        timeout: seconds after which the job is cancelled and JobCancelled raised
+        priority, pipeline: see put()
         """
+        if self.route_inprocess(txt):
+            return self.run_inprocess(txt)
+
         # Make sure that the request will not be blocked for a long time
-        # Ongoing jobs + 1 should less than 5, or return False
-        if self.job_counter - len(self.done_jobs) + 1 > 5:
-            self.empty_q_out()
+        if not self.admit(len(txt)):
             return False
 
-        job_id = self.put(txt)
-        while True:
-            res = self.get(job_id)
-            if res is None:
-                time.sleep(0.1)
+        job_id = self.put(txt,
+                          deadline=self.deadline(timeout),
+                          priority=priority,
+                          pipeline=pipeline)
+        return self.get(job_id)
+
+    def deadline(self, timeout):
+        return time.time() + timeout if timeout else None
+
+    def wrap_future(self, batch_id, loop=None):
+        """
+        Return an asyncio future on loop which the dispatcher thread
+        resolves (through loop.call_soon_threadsafe) with the result of batch_id
+        loop: the running loop by default, code outside of it must give one
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        future = self.job_future(batch_id)
+        aio_future = loop.create_future()
+
+        def set_result(f):
+            if aio_future.done():
+                return
+            if f.exception() is not None:
+                aio_future.set_exception(f.exception())
             else:
-                break
-        return res
+                aio_future.set_result(f.result())
+
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(set_result, f))
+        return aio_future
+
+    async def put_async(self,
+                        txt,
+                        deadline=None,
+                        priority=INTERACTIVE,
+                        pipeline=None):
+        """put() without blocking the event loop when q_in is full"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.put, txt, False,
+                                          deadline, priority, pipeline)
+
+    async def get_async(self, batch_id):
+        try:
+            return await self.wrap_future(batch_id)
+        except asyncio.CancelledError:  #the caller gave up, e.g. asyncio.wait_for() timed out
+            self.cancel(batch_id)
+            raise
+        finally:
+            self.pop_job(batch_id)
+
+    async def parse_async(self,
+                          txt,
+                          timeout=None,
+                          priority=INTERACTIVE,
+                          pipeline=None):
+        """
+        asyncio version of parse(),
+        return res if queue is not full, else return False
+        """
+        if self.route_inprocess(txt):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.run_inprocess, txt)
+        if not self.admit(len(txt)):
+            return False
+        job_id = await self.put_async(txt, self.deadline(timeout), priority,
+                                      pipeline)
+        return await self.get_async(job_id)
+
+    async def results_async(self, job_ids):
+        """
+        Async iterator yielding (job_id, result) for the given jobs
+        in the order in which they finish
+        """
+        loop = asyncio.get_running_loop()
+        pending = {
+            self.wrap_future(job_id, loop): job_id
+            for job_id in job_ids
+        }
+        while pending:
+            done, _ = await asyncio.wait(pending,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for aio_future in done:
+                job_id = pending.pop(aio_future)
+                self.pop_job(job_id)
+                yield job_id, aio_future.result()
 
     def chunk_plain_text(self, txt, max_char=15000):
         """
-        Divide large plain text into chunks
-        """
-        ck_num = int(len(txt) / max_char)
-        # list of chunks
-        chunks = []
-        # offsets of chunks
-        offsets = [[0, 0]]
-
-        blank_line = re.compile('\n\s*\n')
-        for i in range(ck_num):
-            # reverse the chunk and find the index of end of sentence/word
-            tmp_str = txt[offsets[i][0]:(i + 1) * max_char][::-1]
-
-            # Spliting
-            if blank_line.search(tmp_str):
-                eos_index = blank_line.search(tmp_str).start()
-            if '\n' in tmp_str:
-                eos_index = tmp_str.index('\n')
-            elif '.' in tmp_str:
-                eos_index = tmp_str.index('.')
-            else:
-                eos_index = tmp_str.index(' ')
-
-            # eos_index = tmp_str.index('.') if '.' in tmp_str else tmp_str.index(' ')
-            offsets[i][1] = len(tmp_str) - eos_index + offsets[i][0]
-            # the eos_index is the start index of the next
-            offsets.append([offsets[i][1], offsets[i][1]])
-        # add the remaining words to the last chunk
-        if offsets[ck_num][0] != len(txt):
-            offsets[ck_num - 1][1] = len(txt)
-        # split the txt using the offsets list
-        for offset in offsets[:-1]:
-            chunks.append(txt[offset[0]:offset[1]].strip())
-        logging.debug(f'chunks: {chunks}')
+        Divide large plain text into chunks of at most max_char characters,
+        return (offset in txt, chunk, starts a paragraph) triples, see
+        text_chunks()
+        """
+        chunks = [(start, txt[start:end], paragraph)
+                  for start, end, paragraph in text_chunks(txt, max_char)]
+        logging.debug(f'chunks: {len(chunks)}')
         return chunks
 
-    def parse_large_txt(self, large_txt, max_char):
+    def parse_large_txt(self, large_txt, max_char, priority=BULK):
         """
         The function divide the txt into small chunks and
-        add chunks to the job queue
+        add chunks to the job queue, they are parsed in parallel and
+        stitched back into one document, see fetch_large_job() and
+        report_large_job()
         large_txt: string object but a large one
-        return: Job id if queue not full, False if queue is full
+        priority: see put(), by default the chunks let interactive requests
+                  overtake them
+        return: Job id if queue not full, False if queue is full, the chunks
+                are put by a thread of their own so this returns right away
         """
-        chunks = self.chunk_plain_text(large_txt, max_char)
-        print('number of chunks', len(chunks))
-
         # Make sure that the request will not be blocked for a long time
-        # Ongoing jobs + potential jobs should less than 8, or return False
-        # logging.info(self.job_counter)
-        # logging.info(self.done_jobs)
-        if len(chunks) + self.job_counter - len(self.done_jobs) > 8:
-            self.empty_q_out()
+        if not self.admit(len(large_txt)):
             return False
 
-        job_ids = []
-        for chunk in chunks:
-            job_ids.append(self.put(chunk))
-        large_job_id = '%'.join(job_ids)
-        self.large_jobs.append(large_job_id)
+        chunks = self.chunk_plain_text(large_txt, max_char)
+        large_job = LargeJob(len(chunks))
+        large_job_id = "large-" + hashlib.md5(
+            str(random.random()).encode("utf-8")).hexdigest()
+        with self.jobs_lock:
+            self.large_jobs[large_job_id] = large_job
+        threading.Thread(target=self.put_large_job,
+                         args=(large_job, chunks, priority),
+                         daemon=True).start()
         return large_job_id
 
+    def put_large_job(self, large_job, chunks, priority):
+        """Put the chunks of a large job one by one, they wait at the entry when the pipeline is full"""
+        for offset, chunk, paragraph in chunks:
+            with self.jobs_lock:
+                if large_job.forgotten:
+                    return
+            try:
+                job_id = self.put(chunk, priority=priority)
+            except Exception as e:  #fetch_large_job() raises it
+                with self.jobs_lock:
+                    large_job.error = f"Could not put a chunk of the large job: {e}"
+                return
+            with self.jobs_lock:
+                forgotten = large_job.forgotten
+                if not forgotten:
+                    large_job.chunks.append((job_id, offset, paragraph))
+            if forgotten:  #dropped while this chunk was waiting to enter
+                self.cancel(job_id)
+                self.pop_job(job_id)
+                return
+            self.job_future(job_id).add_done_callback(
+                lambda f: self.chunk_done(large_job, f))
+
+    def chunk_done(self, large_job, future):
+        tokens = 0
+        if not future.cancelled() and future.exception() is None:
+            tokens = measure(future.result())[2]
+        with self.jobs_lock:
+            large_job.done += 1
+            large_job.tokens += tokens
+
+    def large_job(self, large_job_id):
+        with self.jobs_lock:
+            large_job = self.large_jobs.get(large_job_id)
+        if large_job is None:
+            raise KeyError(f"Unknown large job id {large_job_id}")
+        return large_job
+
+    def large_job_progress(self, large_job_id):
+        """
+        {"chunks", "chunks_done", "chunks_fetched", "tokens_done"} of a
+        large job, KeyError if it is unknown or fetched whole already
+        """
+        large_job = self.large_job(large_job_id)
+        with self.jobs_lock:
+            return large_job.progress()
+
+    def fetch_large_job(self, large_job_id):
+        """
+        Return (CoNLL-U, finished): the finished chunks at the start of the
+        large job which were not fetched yet, stitched on to the ones fetched
+        before, and whether that was the last of the job, the fetched chunks
+        are forgotten and the job once it is all fetched, so a huge text need
+        not be kept whole, raise JobFailed if a chunk failed or could not
+        be put
+        """
+        large_job = self.large_job(large_job_id)
+        with self.jobs_lock:
+            error = large_job.error
+            chunks = list(large_job.chunks)
+            first, sent_id = large_job.fetched == 0, large_job.sent_id
+        if error is not None:
+            self.forget_large_job(large_job_id)
+            raise JobFailed(error)
+        parts = []
+        for job_id, offset, paragraph in chunks:
+            if not self.is_done(job_id):  #the chunks after it are not fetched yet either
+                break
+            try:
+                parts.append((self.get(job_id), offset, paragraph))
+            except JobFailed:
+                self.forget_large_job(large_job_id)
+                raise
+        conllu, sent_id = stitch_chunks(parts, first, sent_id)
+        with self.jobs_lock:
+            for _ in parts:
+                large_job.chunks.popleft()
+            large_job.sent_id = sent_id
+            large_job.fetched += len(parts)
+            finished = large_job.fetched == large_job.total
+            if finished:
+                self.large_jobs.pop(large_job_id, None)
+        return conllu, finished
+
+    def forget_large_job(self, large_job_id):
+        """Drop a large job, cancelling its chunks which are not done yet"""
+        with self.jobs_lock:
+            large_job = self.large_jobs.pop(large_job_id, None)
+            if large_job is None:
+                return
+            large_job.forgotten = True  #the chunks not put yet never will be
+            chunks = list(large_job.chunks)
+        for job_id, _, _ in chunks:
+            self.cancel(job_id)
+            self.pop_job(job_id)
+
     def report_large_job(self, job_id):
         """
         Given a job_id, this function can return its progress,
-        if done, return the [True, result],
+        if done, return the [True, result] with the CoNLL-U of the text not
+        fetched yet, see fetch_large_job(),
         if not done, return the [False, progress]
         if doesn't find the job_id, return [False]
+        raise JobFailed if a chunk failed or could not be put
         """
-        self.empty_q_out()
         # Either wrong job_id or already retrieved the result
-        print('large jobs', self.large_jobs)
-        if job_id not in self.large_jobs:
-            return [False]
-        # get job_ids from the large_job_id
-        job_ids = self.large_jobs[self.large_jobs.index(job_id)].split('%')
-        ct = 0
-        # get progress report
-        for idx in job_ids:
-            if idx in self.done_jobs: ct += 1
-        # all jobs are done
-        if ct == len(job_ids):
-            res = []
-            for idx in job_ids:
-                res.append(self.done_jobs.pop(idx))
-                self.job_counter -= 1
-            self.large_jobs.remove(job_id)
-            # TODO Meta data in return, i.e, wrong sent_id
-            return [True, res]
+        with self.jobs_lock:
+            large_job = self.large_jobs.get(job_id)
+            if large_job is None:
+                return [False]
+            progress = large_job.progress()
+            failed = large_job.error is not None
+        # all jobs are done, or fetch_large_job() raises the error
+        if failed or progress["chunks_done"] == progress["chunks"]:
+            return [True, self.fetch_large_job(job_id)[0]]
         else:
-            return [False, "Progress: %d percent" % (100 * ct / len(job_ids))]
-
-    def parse_batched(
-        self,
-        inp,
-    ):
-        """inp: is a file-like object with input data
-           yield_res: 
-           """
-        pass
+            return [
+                False, "Progress: %d percent, %d of %d chunks, %d tokens" %
+                (100 * progress["chunks_done"] / progress["chunks"],
+                 progress["chunks_done"], progress["chunks"],
+                 progress["tokens_done"])
+            ]
+
+    def parse_batched(self,
+                      inp,
+                      batch_lines=0,
+                      empty_line_batching=False,
+                      max_batches=None,
+                      priority=BULK,
+                      batch_chars=100000,
+                      batch_tokens=0):
+        """
+        Parse a file-like object of text or CoNLL-U and yield the CoNLL-U
+        results batch by batch in the input order, each as soon as it and
+        the ones before it are done
+        inp: iterable of lines, e.g. an open file
+        batch_lines, batch_chars, batch_tokens: cut a batch once it has about
+                     this many lines, characters or tokens, whichever comes
+                     first, 0 for no limit, see Batcher
+        empty_line_batching: cut only at empty lines, for CoNLL-U input
+        max_batches: batches in the pipeline at a time, max_q_size by
+                     default, reading inp waits while this many are not
+                     yielded so memory stays bounded however long inp is
+        priority: see put()
+        """
+        if max_batches is None:
+            max_batches = self.max_q_size
+        batcher = Batcher(batch_lines, batch_chars, batch_tokens,
+                          empty_line_batching)
+        in_flight = collections.deque()  # job ids in input order
+        try:
+            for line in inp:
+                batch = batcher.add(line)
+                if batch is None:
+                    continue
+                if len(in_flight) >= max_batches:
+                    yield self.get(in_flight.popleft())
+                in_flight.append(self.put(batch, priority=priority))
+            batch = batcher.finish()
+            if batch is not None:
+                in_flight.append(self.put(batch, priority=priority))
+            while in_flight:
+                yield self.get(in_flight.popleft())
+        finally:  #the caller stopped early or a batch failed
+            for job_id in in_flight:
+                self.cancel(job_id)
+                self.pop_job(job_id)
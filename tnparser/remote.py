@@ -0,0 +1,333 @@
+import importlib
+import json
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from tnparser.conllu import to_conllu
+
+# a frame on the wire is its length followed by a JSON list of two strings in
+# UTF-8: ["hello", module name], ["error", message], or [jobid, CoNLL-U] for a
+# job and its result, plain data so that a frame cannot run code in its reader
+header = struct.Struct("!I")
+
+
+def parse_address(address):
+    """(host, port) of "tcp://host:port" """
+    if not address.startswith("tcp://"):
+        raise ValueError(f"Remote step address is not tcp://host:port: {address}")
+    host, _, port = address[len("tcp://"):].rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Remote step address is not tcp://host:port: {address}")
+    return host.strip("[]"), int(port)
+
+
+def send_frame(sock, obj):
+    data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    sock.sendall(header.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf += chunk
+    return buf
+
+
+def recv_frame(sock):
+    """The [kind or jobid, text] of the next frame, ValueError if it is not one"""
+    size, = header.unpack(recv_exactly(sock, header.size))
+    frame = json.loads(recv_exactly(sock, size).decode("utf-8"))
+    if not (isinstance(frame, list) and len(frame) == 2
+            and isinstance(frame[0], str)
+            and isinstance(frame[1], (str, type(None)))):  #None: a tombstone
+        raise ValueError("Malformed frame")
+    return frame
+
+
+def close(sock):
+    """Close sock, waking up a thread blocked reading it"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def keepalive(sock):
+    """Notice a peer which went away without closing the connection"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", 10), ("TCP_KEEPINTVL", 5),
+                          ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, option):  #Linux
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                            value)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class Worker:
+    """
+    The far end of a remote step: runs the launch() loop of the module on
+    the jobs of the pipeline connected to it and sends the results back,
+    the model stays loaded when the pipeline reconnects, a new connection
+    replaces the previous one, if the module fails the pipeline is told
+    before the worker exits
+    """
+
+    def __init__(self, step, host, port):
+        module_name_and_params = step.split()
+        self.module_name = module_name_and_params[0]
+        self.mod = importlib.import_module("tnparser." + self.module_name)
+        self.args = self.mod.argparser.parse_args(module_name_and_params[1:])
+        self.server = socket.create_server((host, port))
+        self.q_in = queue.Queue()
+        self.q_out = queue.Queue()
+        self.conn = None
+        self.conn_lock = threading.Lock()
+
+    def run(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        threading.Thread(target=self.send_results, daemon=True).start()
+        print(f"Serving {self.module_name} on {self.server.getsockname()}",
+              file=sys.stderr,
+              flush=True)
+        try:
+            self.mod.launch(self.args, self.q_in, self.q_out)
+        except Exception:
+            self.report_error(traceback.format_exc())
+            raise
+
+    def report_error(self, message):
+        """Tell the connected pipeline that the step failed, it does not wait for the worker then"""
+        with self.conn_lock:
+            if self.conn is None:
+                return
+            try:
+                send_frame(self.conn, ["error", message])
+            except OSError:
+                pass
+
+    def accept(self):
+        while True:
+            conn, peer = self.server.accept()
+            try:
+                keepalive(conn)
+                kind, module_name = recv_frame(conn)
+                if kind != "hello" or module_name != self.module_name:
+                    send_frame(conn, ["error", f"this worker runs {self.module_name}"])
+                    conn.close()
+                    continue
+                send_frame(conn, ["hello", self.module_name])
+            except (OSError, ValueError):
+                conn.close()
+                continue
+            with self.conn_lock:
+                if self.conn is not None:
+                    close(self.conn)
+                self.conn = conn
+                # the jobs of the previous connection are sent again
+                while True:
+                    try:
+                        self.q_in.get_nowait()
+                    except queue.Empty:
+                        break
+            print(f"Pipeline connected from {peer}",
+                  file=sys.stderr,
+                  flush=True)
+            threading.Thread(target=self.read_jobs, args=(conn, ),
+                             daemon=True).start()
+
+    def read_jobs(self, conn):
+        while True:
+            try:
+                jobid, txt = recv_frame(conn)
+            except (OSError, ValueError):
+                return
+            with self.conn_lock:
+                if conn is not self.conn:  #replaced
+                    return
+                self.q_in.put((jobid, txt))
+
+    def send_results(self):
+        while True:
+            jobid, txt = self.q_out.get()[:2]
+            if jobid == "FINAL":
+                return
+            with self.conn_lock:
+                if self.conn is None:
+                    continue
+                try:
+                    send_frame(self.conn, [jobid, to_conllu(txt)])
+                except OSError:  #the pipeline sends the job again when it reconnects
+                    close(self.conn)
+                    self.conn = None
+
+
+class RemoteStep:
+    """
+    The pipeline end of a remote step: sends the jobs to the worker, at most
+    window of them unanswered at a time, and hands the results on in the
+    order the jobs came, on a broken connection it reconnects and sends the
+    unanswered jobs again, if the worker fails or cannot be reached for
+    timeout seconds run() raises ConnectionError and the supervisor of the
+    pipeline restarts the step
+    """
+
+    def __init__(self, address, module_name, window, timeout=60.0):
+        self.address = parse_address(address)
+        self.module_name = module_name
+        self.window = max(window, 1)
+        self.timeout = timeout
+        self.error = None  # why the step cannot go on, raised by run()
+        self.inflight = OrderedDict()  # jobid -> [txt, result or None]
+        self.cond = threading.Condition()
+        self.sock = None
+        self.generation = 0  # connections made so far
+        self.conn_lock = threading.Lock()
+        self.deliver_lock = threading.Lock()  # held while results go to q_out
+
+    def connect(self):
+        """
+        Connect until it succeeds, backing off up to 5 seconds between tries,
+        ConnectionError after trying for timeout seconds
+        """
+        delay = 0.1
+        give_up = time.time() + self.timeout
+        while True:
+            try:
+                sock = socket.create_connection(self.address)
+                keepalive(sock)
+                send_frame(sock, ["hello", self.module_name])
+                kind, message = recv_frame(sock)
+                if kind != "hello":
+                    sock.close()
+                    raise ValueError(
+                        f"Remote step {self.address}: {message}")
+                return sock
+            except OSError as e:
+                if time.time() + delay > give_up:
+                    raise ConnectionError(
+                        f"Remote step {self.module_name} at {self.address}: {e}, gave up after {self.timeout:.0f}s"
+                    ) from e
+                print(
+                    f"Remote step {self.module_name} at {self.address}: {e}, retrying in {delay:.1f}s",
+                    file=sys.stderr,
+                    flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    def reconnect(self, generation):
+        """Replace the connection generation, unless another thread did it already"""
+        with self.conn_lock:
+            if self.generation != generation:
+                return
+            if self.sock is not None:
+                close(self.sock)
+            while True:
+                try:
+                    self.sock = self.connect()
+                except (OSError, ValueError) as e:
+                    self.fail(str(e))
+                    return
+                self.generation += 1
+                with self.cond:
+                    unanswered = [[jobid, job[0]]
+                                  for jobid, job in self.inflight.items()
+                                  if job[1] is None]
+                try:
+                    for item in unanswered:
+                        send_frame(self.sock, item)
+                    return
+                except OSError:
+                    close(self.sock)
+
+    def send(self, jobid, txt):
+        txt = to_conllu(txt)  #a Document from the previous step goes as text
+        with self.conn_lock:
+            generation = self.generation
+            with self.cond:
+                self.inflight[jobid] = [txt, None]
+            try:
+                send_frame(self.sock, [jobid, txt])
+                return
+            except OSError:
+                pass
+        self.reconnect(generation)  #sends it again along with the others
+
+    def fail(self, message):
+        """Stop the step, run() raises ConnectionError(message)"""
+        with self.cond:
+            if self.error is None:
+                self.error = message
+            self.cond.notify_all()
+
+    def check(self):
+        if self.error is not None:
+            raise ConnectionError(self.error)
+
+    def receive(self, q_out):
+        """Thread reading the results, those in order are put to q_out"""
+        while self.error is None:
+            with self.conn_lock:
+                sock, generation = self.sock, self.generation
+            try:
+                jobid, txt = recv_frame(sock)
+            except (OSError, ValueError):
+                self.reconnect(generation)
+                continue
+            if jobid == "error":
+                self.fail(f"Remote step {self.module_name} at {self.address} failed:\n{txt}")
+                return
+            with self.deliver_lock:
+                ready = []
+                with self.cond:
+                    job = self.inflight.get(jobid)
+                    if job is None or job[1] is not None:  #answered already before a reconnect
+                        continue
+                    job[1] = txt
+                    while self.inflight and next(iter(
+                            self.inflight.values()))[1] is not None:
+                        ready.append(self.inflight.popitem(last=False))
+                    self.cond.notify_all()
+                for jobid, (_, result) in ready:
+                    q_out.put((jobid, result))
+
+    def run(self, q_in, q_out):
+        self.sock = self.connect()
+        threading.Thread(target=self.receive, args=(q_out, ),
+                         daemon=True).start()
+        while True:
+            try:
+                jobid, txt = q_in.get(timeout=1.0)
+            except queue.Empty:  #look at the worker now and then while idle
+                self.check()
+                continue
+            if jobid == "FINAL":
+                with self.cond:
+                    self.cond.wait_for(
+                        lambda: not self.inflight or self.error is not None)
+                self.check()
+                with self.deliver_lock:  #after the last results
+                    q_out.put((jobid, txt))
+                close(self.sock)
+                return
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.inflight) < self.window or
+                                   self.error is not None)
+            self.check()
+            self.send(jobid, txt)
+
+
+def launch_remote(config, q_in, q_out):
+    """
+    Run a step on a remote worker, see Worker
+    config: (tcp://host:port address, module_name, window, timeout)
+    """
+    RemoteStep(*config).run(q_in, q_out)
@@ -0,0 +1,83 @@
+import bz2
+import gzip
+import io
+import lzma
+import queue
+import sys
+import threading
+
+# leading bytes of the compressed formats read transparently -> reader of a binary file
+MAGIC = ((b"\x1f\x8b", lambda raw: gzip.GzipFile(fileobj=raw)),
+         (b"BZh", bz2.BZ2File), (b"\xfd7zXZ\x00", lzma.LZMAFile))
+# name endings of the compressed formats written -> writer of a path, gzip
+# at the default level of zlib, much faster than the maximum and hardly larger
+SUFFIXES = ((".gz", lambda path: gzip.GzipFile(path, "wb", compresslevel=6)),
+            (".bz2", lambda path: bz2.BZ2File(path, "wb")),
+            (".xz", lambda path: lzma.LZMAFile(path, "wb")))
+# compressed output is written in blocks of this many bytes
+WRITE_BUFFER = 1 << 20
+
+
+def open_input(path):
+    """
+    Text lines of the file at path, "-" for stdin, decompressed if it is
+    gzip, bz2 or xz whatever its name
+    """
+    if path == "-":
+        raw = sys.stdin.buffer
+    else:
+        raw = open(path, "rb")
+    head = raw.peek(6)[:6]
+    for magic, compressed in MAGIC:
+        if head.startswith(magic):
+            return io.TextIOWrapper(compressed(raw), encoding="utf-8")
+    if path == "-":
+        return sys.stdin
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def open_output(path):
+    """
+    Text file at path, "-" for stdout, compressed if the name ends with .gz,
+    .bz2 or .xz, which is then written in large blocks
+    """
+    if path == "-":
+        return sys.stdout
+    for suffix, compressed in SUFFIXES:
+        if path.endswith(suffix):
+            return io.TextIOWrapper(io.BufferedWriter(compressed(path),
+                                                      WRITE_BUFFER),
+                                    encoding="utf-8")
+    return open(path, "wt", encoding="utf-8", buffering=WRITE_BUFFER)
+
+
+def read_ahead(f, lines=1000, chunks=16):
+    """
+    Iterate over the lines of f read by a thread ahead of the consumer, in
+    chunks of lines, at most chunks of them waiting: the decompression and
+    decoding of the input overlap with the parsing
+    """
+    q = queue.Queue(chunks)
+
+    def read():
+        try:
+            chunk = []
+            for line in f:
+                chunk.append(line)
+                if len(chunk) >= lines:
+                    q.put(chunk)
+                    chunk = []
+            q.put(chunk)
+        except BaseException as e:  #raised again in the consumer
+            q.put(e)
+            return
+        q.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        chunk = q.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield from chunk
@@ -53,6 +53,10 @@ class UDPipeTokenizerWrapper():
         return tokenized
 
 
+def stage(args):
+    return UDPipeTokenizerWrapper(args).parse_text
+
+
 def launch(args, q_in, q_out):
     t = UDPipeTokenizerWrapper(args)
     while True:
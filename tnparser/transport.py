@@ -0,0 +1,93 @@
+import pickle
+import sys
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+
+class SharedPickle:
+    """Handle of a pickled job (text or Document) stored in a shared memory segment"""
+
+    __slots__ = ("name", "size")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    @classmethod
+    def store(cls, data):
+        """data: the pickled job"""
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        handle = cls(shm.name, len(data))
+        shm.close()  #the segment lives on until the reader unlinks it
+        return handle
+
+    def read(self):
+        """Unpickle the job and free the segment, a handle can be read only once"""
+        shm = shared_memory.SharedMemory(name=self.name)
+        view = shm.buf[:self.size]
+        try:
+            return pickle.loads(view)
+        finally:
+            view.release()
+            shm.close()
+            shm.unlink()
+
+
+class SharedMemoryQueue:
+    """
+    Drop-in wrapper of a multiprocessing queue of (jobid, txt, ...) tuples which
+    pickles the job text or Document itself and passes it through shared
+    memory if it takes at least min_bytes, only the small handle is pickled
+    through the queue then, creating a segment costs more than sending short
+    jobs through the pipe (see bench_transport.py) so those still go through
+    the queue, as the bytes already pickled; either way the feed and merge of
+    replicas relay them as they are, without unpickling
+    """
+
+    def __init__(self, queue, min_bytes=1 << 19):
+        self.queue = queue
+        self.min_bytes = max(min_bytes, 1)  #empty segments are not allowed
+
+    def put(self, item, block=True, timeout=None):
+        jobid, txt = item[:2]
+        if txt is not None:  #None is a tombstone, which the merge of replicas looks at
+            txt = pickle.dumps(txt, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(txt) >= self.min_bytes:
+                txt = SharedPickle.store(txt)
+        self.queue.put((jobid, txt) + tuple(item[2:]), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        item = self.queue.get(block, timeout)
+        if isinstance(item[1], SharedPickle):
+            item = (item[0], item[1].read()) + item[2:]
+        elif isinstance(item[1], bytes):
+            item = (item[0], pickle.loads(item[1])) + item[2:]
+        return item
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+
+def prepare():
+    """
+    Start the resource tracker before the stages are forked so that all of
+    them share it, a segment created in one stage and unlinked in another is
+    then not reported as leaked
+    """
+    try:
+        resource_tracker.ensure_running()
+    except Exception as e:
+        print("Warning: could not start the shared memory resource tracker:",
+              e,
+              file=sys.stderr,
+              flush=True)
@@ -3,14 +3,41 @@ import yaml
 import os
 import flask
 import sys
-from tnparser.pipeline import Pipeline, read_pipelines
+from tnparser.pipeline import Pipeline, JobCancelled, read_pipelines
 
 app=flask.Flask(__name__)
 model=os.environ.get("TNPP_MODEL","models_fi_tdt/pipelines.yaml")
-pipeline=os.environ.get("TNPP_PIPELINE","parse_plaintext")
+pipelines=os.environ.get("TNPP_PIPELINE","parse_plaintext").split(",") #several comma-separated pipelines share their common steps, choose with ?pipeline=name
 max_char=int(os.environ.get("TNPP_MAX_CHARS",15000))
+inprocess_max_chars=int(os.environ.get("TNPP_INPROCESS_MAX_CHARS",0)) #parse shorter texts without the pipeline processes
+max_chars_in_flight=int(os.environ.get("TNPP_MAX_CHARS_IN_FLIGHT",120000)) #busy above this many characters being parsed
+max_wait=float(os.environ.get("TNPP_MAX_WAIT",0)) #busy if the estimated wait is longer, seconds, 0 for no limit
+job_timeout=float(os.environ.get("TNPP_JOB_TIMEOUT",0)) #give up on a text not parsed in this many seconds, 0 for no limit
+mode=os.environ.get("TNPP_MODE","process") #"thread" runs the steps as threads of this process
 available_pipelines=read_pipelines(model)
-p=Pipeline(available_pipelines[pipeline])
+if len(pipelines)==1:
+    steps=available_pipelines[pipelines[0]]
+else: #the in-process parsing of short texts needs a single pipeline
+    steps={name:available_pipelines[name] for name in pipelines}
+    inprocess_max_chars=0
+p=Pipeline(steps,mode="hybrid" if inprocess_max_chars>0 and mode=="process" else mode,inprocess_max_chars=inprocess_max_chars,max_chars_in_flight=max_chars_in_flight,max_wait=max_wait)
+
+def busy():
+    wait=p.estimated_wait()
+    retry_after=str(max(1,int(wait))) if wait is not None else "1"
+    return flask.Response("The parser is busy, please try again later.\n",status=503,headers={"Retry-After":retry_after},mimetype="text/plain; charset=utf-8")
+
+def parse(txt):
+    pipeline=flask.request.args.get("pipeline",pipelines[0])
+    if pipeline not in pipelines:
+        flask.abort(flask.Response(f"Unknown pipeline {pipeline}, this server runs {','.join(pipelines)}\n",status=400,mimetype="text/plain; charset=utf-8"))
+    try:
+        return p.parse(txt,timeout=job_timeout,pipeline=pipeline)
+    except JobCancelled:
+        return None
+
+def timed_out():
+    return flask.Response("Parsing took too long and was given up.\n",status=504,mimetype="text/plain; charset=utf-8")
              
 @app.route("/",methods=["GET"])
 def parse_get():
@@ -18,7 +45,11 @@ def parse_get():
     txt=flask.request.args.get("text")
     if not txt:
         return "You need to specify ?text=sometext",400
-    res=p.parse(txt)
+    res=parse(txt)
+    if res is False:
+        return busy()
+    if res is None:
+        return timed_out()
     return flask.Response(res,mimetype="text/plain; charset=utf-8")
 
 @app.route("/",methods=["POST"])
@@ -30,7 +61,14 @@ def parse_post():
     if not txt:
         return """You need to post your data as a single string. An example request would be curl --request POST --data 'Tämä on testilause' http://localhost:7689\n\n\n""",400
     else:
-        res=p.parse(txt)
+        res=parse(txt)
+    if res is False:
+        return busy()
+    if res is None:
+        return timed_out()
     return flask.Response(res,mimetype="text/plain; charset=utf-8")
 
-
+@app.route("/metrics",methods=["GET"])
+def metrics():
+    global p
+    return flask.Response(p.metrics_text(),mimetype="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+import argparse
+import sys
+from tnparser.pipeline import cpu_quota, parse_cpus, place
+from tnparser.remote import Worker
+
+if __name__=="__main__":
+    argparser = argparse.ArgumentParser(description='Run one pipeline step for a pipeline on another machine, which points at it with "remote: tcp://host:port" in its pipelines.yaml. The model stays loaded when the pipeline reconnects. Jobs go over the connection as CoNLL-U text, unencrypted and unauthenticated, so open the port to the pipeline machines only.')
+    argparser.add_argument('--host', default="127.0.0.1", help='Address to listen on, 0.0.0.0 for all interfaces. Default %(default)s')
+    argparser.add_argument('--port', default=7690, type=int, help='Port to listen on. Default %(default)d')
+    argparser.add_argument('--threads', type=int, help='Threads of the torch step. Default: the CPU quota of the cgroup')
+    argparser.add_argument('--cpus', help='CPUs to run on, for example 0-3,8. Default: all')
+    argparser.add_argument('step', nargs=argparse.REMAINDER, help='The step as in pipelines.yaml, for example lemmatizer_mod --model models_fi_tdt_dia/Lemmatizer/lemmatizer.pt --replace_unk')
+    args = argparser.parse_args()
+    if not args.step:
+        argparser.error("no step given")
+    if args.cpus:
+        place(cpus=parse_cpus(args.cpus))
+    place(threads=args.threads or cpu_quota()) #the quota of the CPUs pinned to
+    Worker(" ".join(args.step),args.host,args.port).run()
+    print("Worker exiting",file=sys.stderr,flush=True)
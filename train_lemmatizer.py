@@ -10,7 +10,8 @@ from shutil import copyfile, rmtree
 import re
 from distutils.util import strtobool
 
-from tnparser.lemmatizer_mod import Lemmatizer, read_conllu
+from tnparser.conllu import Document
+from tnparser.lemmatizer_mod import Lemmatizer
 
 ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
 
@@ -35,7 +36,7 @@ def create_dataset(fname):
     lemmatizer = Lemmatizer()
     data=[]
     with open(fname, "rt", encoding="utf-8") as f:
-        for comm, sent in read_conllu(f):
+        for comm, sent in Document.from_conllu(f.read()).sentences():
             for token in sent:
                 word, lemma = lemmatizer.transform_token(token)
                 data.append((word, lemma))